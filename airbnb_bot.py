@@ -11,88 +11,382 @@ LICENSE for the full license text.
 
 from __future__ import print_function, unicode_literals
 import requests
-from bs4 import BeautifulSoup
+from urllib3.util.retry import Retry
 import json
-from textblob import TextBlob
-import nltk
+import csv
+import hashlib
 import random
 import logging
 import os
 import sys
 import time
-#import re
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
 import sqlite3
 from sqlite3 import Error
-from collections import Counter
+from collections import Counter, OrderedDict
 from math import sqrt
+from functools import lru_cache
 import string
 from datetime import datetime
 import warnings
-warnings.filterwarnings("ignore")
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
 from config import *
 
 TOBOT_VERSION = '0.1-b.1'
 __version__ = TOBOT_VERSION
 
-# set up logging
-#logging.basicConfig()
 logger = logging.getLogger(name='TOBOT')
-logger.setLevel(logging.DEBUG)
-logging.addLevelName(
-        logging.INFO, "\033[1;32m%s\033[1;0m"
-                      % logging.getLevelName(logging.INFO))
-logging.addLevelName(
-    logging.WARNING, "\033[1;31m%s\033[1;0m"
-                        % logging.getLevelName(logging.WARNING))
-logging.addLevelName(
-    logging.ERROR, "\033[1;41m%s\033[1;0m"
-                    % logging.getLevelName(logging.ERROR))
-logging.addLevelName(
-    logging.DEBUG, "\033[1;33m%s\033[1;0m"
-                    % logging.getLevelName(logging.DEBUG))
 logformatter = '%(asctime)s [%(levelname)s][%(name)s] %(message)s'
 loglevel = logging.DEBUG
-logging.basicConfig(format=logformatter, level=loglevel)
+
+def setup_logging():
+    """Set up colored logging to the console and hide library warnings, called by
+    the scripts at start up so importing airbnb_bot doesn't change the logging
+    configuration."""
+    warnings.filterwarnings("ignore")
+    logger.setLevel(logging.DEBUG)
+    logging.addLevelName(
+            logging.INFO, "\033[1;32m%s\033[1;0m"
+                          % logging.getLevelName(logging.INFO))
+    logging.addLevelName(
+        logging.WARNING, "\033[1;31m%s\033[1;0m"
+                            % logging.getLevelName(logging.WARNING))
+    logging.addLevelName(
+        logging.ERROR, "\033[1;41m%s\033[1;0m"
+                        % logging.getLevelName(logging.ERROR))
+    logging.addLevelName(
+        logging.DEBUG, "\033[1;33m%s\033[1;0m"
+                        % logging.getLevelName(logging.DEBUG))
+    logging.basicConfig(format=logformatter, level=loglevel)
+
+
+# metrics
+
+# histogram buckets (upper bounds in seconds) for stage timings
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# airbnbBot counter attributes exported as metrics
+BOT_COUNTERS = (
+    ('message_count', 'threads_total', 'Message threads processed.'),
+    ('message_count_processed', 'messages_marked_read_total', 'Messages marked as read.'),
+    ('reply_count_response', 'replies_total', 'Replies sent to guests.'),
+    ('reply_count_noresponse', 'no_replies_total', 'Guest messages Tobot could not reply to.'),
+)
+
+
+class Metrics():
+    """Timing histograms for each stage of message processing and event counters.
+    Thread fetches run concurrently so metrics are updated under a lock."""
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}  # stage -> [bucket counts, count, sum]
+            self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += 1
+            hist[2] += seconds
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def quantile(self, stage, q):
+        """Estimate a quantile (upper bound of the bucket it falls in) of a stage's timings.
+        Returns None if there are no timings or the quantile is above the last bucket."""
+        with self.lock:
+            hist = self.histograms.get(stage)
+            if hist is None or hist[1] == 0:
+                return None
+            rank = q * hist[1]
+            total = 0
+            for i, n in enumerate(hist[0]):
+                total += n
+                if total >= rank:
+                    return self.buckets[i]
+            return None
+
+    def snapshot(self, bot=None):
+        """Return the metrics as a dict, used for the json stats line."""
+        stages = {}
+        for stage in list(self.histograms):
+            count, total = self.histograms[stage][1:]
+            p95 = self.quantile(stage, 0.95)
+            stages[stage] = {
+                'count': count,
+                'total_s': round(total, 6),
+                'mean_ms': round(total / count * 1000, 3) if count else None,
+                # None if slower than the last bucket, json has no infinity
+                'p95_ms': p95 * 1000 if p95 is not None else None
+            }
+        with self.lock:
+            counters = dict(self.counters)
+        if bot is not None:
+            for attr, name, help_text in BOT_COUNTERS:
+                counters[name] = getattr(bot, attr)
+        return {'stages': stages, 'counters': counters}
+
+    def render(self, bot=None):
+        """Return the metrics in prometheus text exposition format."""
+        lines = [
+            '# HELP tobot_stage_seconds Time spent in each stage of message processing.',
+            '# TYPE tobot_stage_seconds histogram'
+        ]
+        with self.lock:
+            histograms = dict((stage, (list(hist[0]), hist[1], hist[2])) for stage, hist in self.histograms.items())
+            counters = dict(self.counters)
+        for stage in sorted(histograms):
+            buckets, count, total = histograms[stage]
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                lines.append('tobot_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, cumulative))
+            lines.append('tobot_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (stage, count))
+            lines.append('tobot_stage_seconds_sum{stage="%s"} %f' % (stage, total))
+            lines.append('tobot_stage_seconds_count{stage="%s"} %d' % (stage, count))
+        for name in sorted(counters):
+            lines.append('# TYPE tobot_%s_total counter' % name)
+            lines.append('tobot_%s_total %d' % (name, counters[name]))
+        if bot is not None:
+            for attr, name, help_text in BOT_COUNTERS:
+                lines.append('# HELP tobot_%s %s' % (name, help_text))
+                lines.append('# TYPE tobot_%s counter' % name)
+                lines.append('tobot_%s %d' % (name, getattr(bot, attr)))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+@contextmanager
+def timed(stage):
+    """Time a stage of message processing into the metrics,
+    used as a with block or decorator."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(stage, time.perf_counter() - start)
+
+
+def start_metrics_server(port, bot, host='127.0.0.1'):
+    """Serve the metrics in prometheus text format on http://host:port/metrics
+    from a background thread. Returns the server."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render(bot).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
 
 
 # Tobot "brain" data functions
 
-def read_corpus():
+CORPUS_FILE = 'tobot_corpus.txt'
+# directory where the tokenized and fitted corpus is cached between starts
+CORPUS_CACHE_DIR = '.tobot_cache'
+# tokenizer and vectorizer settings the corpus cache was built with,
+# change this when they change so the cache gets rebuilt
+CORPUS_TOKENIZER = 'sent_tokenize/word_tokenize/lem_normalize/stop_words=english/norm=l2'
+# document-term matrix and idf arrays saved in the corpus cache
+CORPUS_CACHE_ARRAYS = ('data', 'indices', 'indptr', 'idf')
+
+
+def read_corpus(corpus_file=CORPUS_FILE):
     """open corpus file and create word and sentence tokens
     corpus file is the base brain for Tobot which contains words/sentences
-    used by nltk and sklearn to help Tobot respond to questions"""
-    f = open('tobot_corpus.txt', 'r', errors='ignore')
+    used by nltk and sklearn to help Tobot respond to questions
+    tokens are loaded from the corpus cache if the corpus hasn't changed.
+    Returns a tuple with the corpus key (hash of the corpus and tokenizer
+    settings), sentence tokens and word tokens."""
+    f = open(corpus_file, 'r', errors='ignore')
     raw = f.read()
     f.close()
     raw = raw.lower()
+    corpus_key = hashlib.sha1((CORPUS_TOKENIZER + '\n' + raw).encode('utf-8')).hexdigest()
+    meta = load_corpus_cache_meta(corpus_key)
+    if meta is not None:
+        return corpus_key, meta['sent_tokens'], meta['word_tokens']
+    import nltk
     #nltk.download('punkt')
     #nltk.download('wordnet')
     #nltk.download('stopwords')
     sent_tokens = nltk.sent_tokenize(raw)
     word_tokens = nltk.word_tokenize(raw)
 
-    return sent_tokens, word_tokens
+    return corpus_key, sent_tokens, word_tokens
+
 
+def load_corpus_cache_meta(key):
+    """Load the corpus cache meta data (json) if it was built from
+    the same corpus and tokenizer settings. Returns None otherwise."""
+    try:
+        with open(os.path.join(CORPUS_CACHE_DIR, 'corpus.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('key') != key:
+        return None
+    return meta
 
-def db_connect():
+
+def load_corpus_cache(key):
+    """Load the fitted corpus index from the corpus cache, the document-term
+    matrix arrays are memory-mapped. Returns None if there is no valid cache."""
+    import numpy as np
+    from scipy.sparse import csr_matrix
+    meta = load_corpus_cache_meta(key)
+    if meta is None:
+        return None
+    try:
+        data, indices, indptr, idf = [np.load(corpus_cache_file(key, name), mmap_mode='r')
+                                      for name in CORPUS_CACHE_ARRAYS]
+    except (OSError, ValueError):
+        return None
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    TfidfVec = TfidfVectorizer(tokenizer=lem_normalize, stop_words='english', norm='l2',
+                               vocabulary=meta['vocabulary'])
+    TfidfVec.idf_ = np.asarray(idf)
+    tfidf = csr_matrix((data, indices, indptr), shape=tuple(meta['shape']), copy=False)
+    return TfidfVec, tfidf
+
+
+def corpus_cache_file(key, name):
+    """Return the path of a corpus cache array file. The arrays of each
+    build are named after the corpus key, so a rebuild never overwrites
+    files that another process (brain cli/bot) has memory-mapped."""
+    return os.path.join(CORPUS_CACHE_DIR, '%s.%s.npy' % (key, name))
+
+
+def save_corpus_cache(key, sent_tokens, word_tokens, TfidfVec, tfidf):
+    """Save the tokenized corpus and fitted corpus index to the corpus cache.
+    Every file is written to a temp file and renamed into place, and the json
+    meta data is written last so a partly written cache is never used."""
+    import numpy as np
+    try:
+        if not os.path.exists(CORPUS_CACHE_DIR):
+            os.makedirs(CORPUS_CACHE_DIR)
+        for name, arr in zip(CORPUS_CACHE_ARRAYS, (tfidf.data, tfidf.indices, tfidf.indptr, TfidfVec.idf_)):
+            filename = corpus_cache_file(key, name)
+            tmpfile = '%s.%s.tmp' % (filename, os.getpid())
+            with open(tmpfile, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmpfile, filename)
+        meta = {
+            'key': key,
+            'shape': list(tfidf.shape),
+            'vocabulary': dict((term, int(i)) for term, i in TfidfVec.vocabulary_.items()),
+            'sent_tokens': sent_tokens,
+            'word_tokens': word_tokens
+        }
+        tmpfile = os.path.join(CORPUS_CACHE_DIR, 'corpus.json.%s.tmp' % os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmpfile, os.path.join(CORPUS_CACHE_DIR, 'corpus.json'))
+    except OSError as e:
+        logger.warning('Unable to save corpus cache. %s' % e)
+        return
+    # remove the arrays of older builds, processes that still have them
+    # memory-mapped keep reading them until they reload
+    for filename in os.listdir(CORPUS_CACHE_DIR):
+        if filename.endswith('.npy') and not filename.startswith(key + '.'):
+            try:
+                os.remove(os.path.join(CORPUS_CACHE_DIR, filename))
+            except OSError:
+                pass
+
+
+# sql statements used to look up and insert words and sentences, these are kept
+# constant so sqlite3 reuses the prepared statements from its statement cache
+ENTITY_STATEMENTS = {
+    'word': {
+        'select': 'SELECT rowid FROM words WHERE word = ?',
+        'insert': 'INSERT INTO words (word) VALUES (?)',
+        'insert_or_ignore': 'INSERT OR IGNORE INTO words (word) VALUES (?)',
+        'select_many': 'SELECT rowid, word FROM words WHERE word IN (%s)'
+    },
+    'sentence': {
+        'select': 'SELECT rowid FROM sentences WHERE sentence = ?',
+        'insert': 'INSERT INTO sentences (sentence) VALUES (?)',
+        'select_many': 'SELECT rowid, sentence FROM sentences WHERE sentence IN (%s)'
+    }
+}
+
+
+def db_connect(dbfile='tobot_db.sqlite'):
     """initialize the connection to the database and 
-    create required tables."""
+    create required tables.
+    The database is opened in WAL journal mode so the brain cli and
+    the running bot can read and write the brain at the same time."""
     try:
-        connection = sqlite3.connect('tobot_db.sqlite')
+        connection = sqlite3.connect(dbfile, timeout=db_busy_timeout, cached_statements=256)
     except Error as e:
         print("Error! cannot create the database connection. %s" % e)
         sys.exit(1)
 
     cursor = connection.cursor()
 
+    # tune the connection, pragma values can't be bound as parameters
+    pragma_list = [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA cache_size=-%d' % int(db_cache_size),  # negative is size in KiB
+        'PRAGMA mmap_size=%d' % int(db_mmap_size),
+    ]
+    for pragma in pragma_list:
+        try:
+            cursor.execute(pragma)
+        except Error as e:
+            print(e)
+
     # create the tables needed by TOBOT to store what it learns
     create_table_request_list = [
         'CREATE TABLE IF NOT EXISTS words(word TEXT UNIQUE)',
         'CREATE TABLE IF NOT EXISTS sentences(sentence TEXT UNIQUE, used INT NOT NULL DEFAULT 0)',
         'CREATE TABLE IF NOT EXISTS associations (word_id INT NOT NULL, sentence_id INT NOT NULL, weight REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS associations_word_id ON associations(word_id)',
+        'CREATE INDEX IF NOT EXISTS associations_sentence_id ON associations(sentence_id)',
+        'CREATE TABLE IF NOT EXISTS processed_threads(thread_id INT PRIMARY KEY, version TEXT NOT NULL, processed_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS processed_threads_processed_at ON processed_threads(processed_at)',
+        'CREATE TABLE IF NOT EXISTS thread_cursors(thread_id INT PRIMARY KEY, last_post_id INT NOT NULL, host_replied INT NOT NULL DEFAULT 0)',
+        'CREATE TABLE IF NOT EXISTS retry_threads(thread_id INT PRIMARY KEY, message TEXT NOT NULL, added_at REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS brain_meta(name TEXT PRIMARY KEY, value INT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS outbox(id INTEGER PRIMARY KEY, account TEXT NOT NULL, key TEXT NOT NULL, '
+        'kind TEXT NOT NULL, thread_id INT NOT NULL, message TEXT, status TEXT NOT NULL, attempts INT NOT NULL DEFAULT 0, '
+        'next_attempt REAL NOT NULL, created_at REAL NOT NULL, sent_at REAL, UNIQUE(account, key))',
+        'CREATE INDEX IF NOT EXISTS outbox_status ON outbox(account, status, next_attempt)',
+        'CREATE TABLE IF NOT EXISTS response_cache(key TEXT PRIMARY KEY, response TEXT, confidence REAL, source TEXT, '
+        'generation INT NOT NULL, corpus_key TEXT NOT NULL, cached_at REAL NOT NULL)',
     ]
     for create_table_request in create_table_request_list:
         try:
@@ -103,23 +397,128 @@ def db_connect():
     return connection, cursor
 
 
+class BrainPool():
+    """Connections to the brain (db) for bots running in several threads,
+    sqlite connections can only be used in the thread that opened them so
+    each thread gets its own connection to the same database (WAL mode lets
+    them read at the same time). The connection and cursor attributes pass
+    calls on to the calling thread's connection and cursor, so they can be
+    used in place of the module's connection and cursor."""
+    class ThreadProxy():
+        def __init__(self, pool, index):
+            self.pool = pool
+            self.index = index
+
+        def __getattr__(self, name):
+            return getattr(self.pool.get()[self.index], name)
+
+    def __init__(self, dbfile='tobot_db.sqlite'):
+        self.dbfile = dbfile
+        self.local = threading.local()
+        self.connection = BrainPool.ThreadProxy(self, 0)
+        self.cursor = BrainPool.ThreadProxy(self, 1)
+
+    def get(self):
+        """Return the calling thread's connection and cursor, connecting on first use."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = db_connect(self.dbfile)
+        return conn
+
+
+class Context():
+    """Tobot's brain (db) and corpus file. Nothing is loaded until it is first
+    used, so importing airbnb_bot is cheap and tools only load what they need.
+    The brain and lookup functions use the module's ctx, set ctx to a new
+    Context to use another brain or corpus file."""
+    def __init__(self, dbfile='tobot_db.sqlite', corpus_file=CORPUS_FILE):
+        self.dbfile = dbfile
+        self.corpus_file = corpus_file
+        self._db = None
+        self._corpus = None
+        self.lock = threading.Lock()
+        # tfidf index of corpus sentences, see get_corpus_index
+        self.corpus_index = None
+        # in-memory brain for the 'matrix' brain engine, see get_brain_matrix
+        self.brain_matrix = None
+        # cache of response() results, see get_response_cache
+        self.response_cache = None
+
+    @property
+    def db(self):
+        """Connections to the brain (db), one for each thread."""
+        if self._db is None:
+            with self.lock:
+                if self._db is None:
+                    self._db = BrainPool(os.path.abspath(self.dbfile))
+        return self._db
+
+    @property
+    def connection(self):
+        return self.db.connection
+
+    @property
+    def cursor(self):
+        return self.db.cursor
+
+    @property
+    def corpus(self):
+        """Tuple with the corpus key, sentence tokens and word tokens, see read_corpus."""
+        if self._corpus is None:
+            with self.lock:
+                if self._corpus is None:
+                    self._corpus = read_corpus(self.corpus_file)
+        return self._corpus
+
+    @property
+    def corpus_key(self):
+        return self.corpus[0]
+
+    @property
+    def sent_tokens(self):
+        return self.corpus[1]
+
+    @property
+    def word_tokens(self):
+        return self.corpus[2]
+
+
 # end data functions
 
-connection, cursor = db_connect()
-sent_tokens, word_tokens = read_corpus()
+ctx = Context()
 
 
 class airbnbBot():
-    def __init__(self, username=None, password=None, apikey='', oauthtoken=''):
+    def __init__(self, username=None, password=None, apikey='', oauthtoken='',
+                 api_url='https://api.airbnb.com', pool_size=10,
+                 timeout=(api_connect_timeout, api_read_timeout), retries=api_retries):
         self.username = username
         self.password = password
         self.useragent = useragent
         self.session = requests.Session()
+        # size the connection pool for the concurrent thread fetches and retry
+        # failed connections and 5xx/429 responses with exponential backoff
+        # (honoring Retry-After), posts are only retried if they couldn't connect
+        retry = Retry(total=retries, backoff_factor=api_retry_backoff,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = timeout
+        self.api_url = api_url.rstrip('/')
+        self.api_headers_set = False
+        self.inbox_error = False
+        self.rate_limited = False
         self.cookies = None
         self.loggedin = False
         self.apikey = apikey
         self.oauthtoken = oauthtoken
-        self.message_ids = []
+        self.processed_threads = ProcessedThreads(ctx.connection, processed_cache_size, processed_ttl_days * 86400)
+        self.reservations = ReservationCache(reservation_cache_size, reservation_cache_ttl)
+        self.outbox = Outbox(ctx.db, username or '', send_rate, send_burst,
+                             send_max_attempts, send_retry_backoff)
         self.message_count = 0
         self.message_count_processed = 0
         self.reply_count_response = 0
@@ -137,8 +536,14 @@ class airbnbBot():
             'Accept': '*/*', 
             'Connection': 'keep-alive'
             }
+        self.api_headers_set = False
 
     def set_headers(self):
+        # headers only need setting once, this also keeps the session headers
+        # from being modified while threads are fetched concurrently
+        if self.api_headers_set:
+            return
+        self.api_headers_set = True
         self.session.headers.update({
                 'cache-control': 'no-cache',
                 'user-agent': self.useragent,
@@ -152,9 +557,26 @@ class airbnbBot():
                 'x-airbnb-currency': 'USD'
                 })
 
+    def check_rate_limit(self, r):
+        # remember if Airbnb rate limited any request (or retry of it) so polling can back off
+        retries = getattr(r.raw, 'retries', None)
+        history = retries.history if retries is not None else ()
+        if history:
+            metrics.inc('api_retries', len(history))
+        if r.status_code == 429 or any(h.status == 429 for h in history):
+            self.rate_limited = True
+
+    def api_request(self, method, path, **kwargs):
+        """Send a request to the Airbnb api and return the decoded json body."""
+        self.set_headers()
+        r = self.session.request(method, self.api_url + path, timeout=self.timeout, **kwargs)
+        self.check_rate_limit(r)
+        return r.json()
+
     def login(self):
         if not self.loggedin:
-            src = self.session.get('https://www.airbnb.com/login').text
+            from bs4 import BeautifulSoup
+            src = self.session.get('https://www.airbnb.com/login', timeout=self.timeout).text
             soup = BeautifulSoup(src, features="html.parser")
             hidden_tags = soup.findAll("input", type="hidden")
             payload = {
@@ -163,7 +585,7 @@ class airbnbBot():
             }
             for tag in hidden_tags:
                 payload[tag.attrs['name']] = tag.attrs['value']
-            r = self.session.post('https://www.airbnb.com/authenticate', data=payload)
+            r = self.session.post('https://www.airbnb.com/authenticate', data=payload, timeout=self.timeout)
             if r.status_code in [200, 302]:
                 self.cookies = self.session.cookies
                 self.loggedin = True
@@ -179,8 +601,8 @@ class airbnbBot():
             'password': self.password
         }
         self.session.headers.update({'Content-Type': 'application/x-www-form-urlencoded', 'x-airbnb-api-key': self.apikey})
-        src = self.session.post('https://api.airbnb.com/v1/authorize', data=payload).text
-        body = json.loads(src)
+        self.api_headers_set = False
+        body = self.session.post(self.api_url + '/v1/authorize', data=payload, timeout=self.timeout).json()
         try:
             if body['error_code']:
                 return None
@@ -194,15 +616,16 @@ class airbnbBot():
 
     def api_key(self):
         self.login()
-        src = self.session.get('https://www.airbnb.com/hosting/inbox').text
+        from bs4 import BeautifulSoup
+        src = self.session.get('https://www.airbnb.com/hosting/inbox', timeout=self.timeout).text
         soup = BeautifulSoup(src, features="html.parser")
         body = soup.find(id='_bootstrap-layout-init')
         body = json.loads(body['content'])
         key = body['api_config']['key']
         return key
 
+    @timed('thread_list')
     def get_message_threads(self, limit=50, offset=0, archived=False, unread=False):
-        self.set_headers()
         qs = {
             '_limit': limit,
             '_offset': offset,
@@ -214,8 +637,7 @@ class airbnbBot():
             qs['role'] = "hidden"
         if unread:
             qs['role'] = "unread"
-        src = self.session.get('https://api.airbnb.com/v2/threads/', params=qs).text
-        body = json.loads(src)
+        body = self.api_request('GET', '/v2/threads/', params=qs)
         try:
             if body['error_code']:
                 return None
@@ -227,16 +649,59 @@ class airbnbBot():
             messages = None
         return messages
 
-    def get_message_thread(self, thread_id, limit=50, offset=0):
+    def iter_message_threads(self, limit=50, archived=False, unread=False, stop=None,
+                             max_pages=None, prefetch=True):
+        """Yield message threads from the hosting inbox, paging with _limit/_offset
+        until there are no more threads or max_pages pages were read.
+        stop is an optional function called with each thread, paging stops at the
+        first thread it returns True for (that thread is not yielded).
+        If prefetch is True the next page is requested while the current page
+        is being processed, if paging doesn't stop in the current page.
+        inbox_error is set if a page could not be read."""
+        self.inbox_error = False
         self.set_headers()
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            offset = 0
+            pages = 1
+            page = self.get_message_threads(limit, offset, archived, unread)
+            while True:
+                if page is None:
+                    self.inbox_error = True
+                    return
+                more = len(page) >= limit and (max_pages is None or pages < max_pages)
+                # find where paging stops before requesting the next page
+                if stop is not None:
+                    for i, thread in enumerate(page):
+                        if stop(thread):
+                            page = page[:i]
+                            more = False
+                            break
+                if more and executor is not None:
+                    next_page = executor.submit(self.get_message_threads, limit, offset + limit, archived, unread)
+                for thread in page:
+                    yield thread
+                if not more:
+                    return
+                offset += limit
+                pages += 1
+                if executor is not None:
+                    page = next_page.result()
+                else:
+                    page = self.get_message_threads(limit, offset, archived, unread)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    @timed('thread_fetch')
+    def get_message_thread(self, thread_id, limit=50, offset=0):
         qs = {
             '_limit': limit,
             '_offset': offset,
             'selected_inbox_type': 'host',
             '_format': 'for_messaging_sync_with_posts'
             }
-        src = self.session.get('https://api.airbnb.com/v2/threads/' + str(thread_id), params=qs).text
-        body = json.loads(src)
+        body = self.api_request('GET', '/v2/threads/' + str(thread_id), params=qs)
         try:
             if body['error_code']:
                 return None
@@ -248,13 +713,57 @@ class airbnbBot():
             messages = None
         return messages
 
-    def get_reservations(self, confirmation_code):
+    def get_message_thread_since(self, thread_id, last_post_id=None, limit=10):
+        """Get a message thread with only the posts newer than last_post_id.
+        Posts are newest first, so they are paged limit posts at a time until
+        last_post_id is reached. All posts are returned if last_post_id is None."""
+        if last_post_id is None:
+            return self.get_message_thread(thread_id)
+        offset = 0
+        posts = []
+        while True:
+            mt = self.get_message_thread(thread_id, limit, offset)
+            if mt is None:
+                return None
+            page = mt['posts']
+            for i, post in enumerate(page):
+                if post['id'] == last_post_id:
+                    mt['posts'] = posts + page[:i + 1]
+                    return mt
+            posts += page
+            if len(page) < limit:
+                mt['posts'] = posts
+                return mt
+            offset += limit
+
+    def fetch_message_threads(self, thread_ids, workers=4, last_post_ids=None, limit=10):
+        """Get many message threads concurrently using a bounded thread pool
+        sharing the session's connection pool. last_post_ids is an optional dict
+        of thread id -> last processed post id, only newer posts are fetched
+        for those threads. Yields (thread_id, thread) tuples in the order they
+        arrive, thread is None on error."""
         self.set_headers()
+        if last_post_ids is None:
+            last_post_ids = {}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = dict((executor.submit(self.get_message_thread_since, thread_id,
+                                            last_post_ids.get(thread_id), limit), thread_id)
+                           for thread_id in thread_ids)
+            for future in as_completed(futures):
+                thread_id = futures[future]
+                try:
+                    mt = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    logger.warning('Error getting message thread %s. %s' % (thread_id, e))
+                    mt = None
+                yield thread_id, mt
+
+    @timed('reservation_fetch')
+    def get_reservations(self, confirmation_code):
         qs = {
             '_format': 'for_mobile_host'
             }
-        src = self.session.get('https://api.airbnb.com/v2/reservations/' + str(confirmation_code), params=qs).text
-        body = json.loads(src)
+        body = self.api_request('GET', '/v2/reservations/' + str(confirmation_code), params=qs)
         try:
             if body['error_code']:
                 return None
@@ -266,14 +775,45 @@ class airbnbBot():
             reservation = None
         return reservation
 
-    def send_message(self, thread_id, message):
+    def prefetch_reservations(self, msgs, workers=4):
+        """Look up the reservations of many parsed message threads, from the
+        reservation cache or concurrently from Airbnb (cached for next time),
+        and set each msg's reservation (None if the thread has no confirmation
+        code or the reservation could not be found)."""
         self.set_headers()
+        missing = {}  # confirmation code -> msgs
+        for msg in msgs:
+            msg['reservation'] = None
+            code = msg['confirmation_code']
+            if code is None:
+                continue
+            hit, reservation = self.reservations.get(code, msg['status'])
+            if hit:
+                msg['reservation'] = reservation
+            else:
+                missing.setdefault(code, []).append(msg)
+        if not missing:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+            futures = dict((executor.submit(self.get_reservations, code), code) for code in missing)
+            for future in as_completed(futures):
+                code = futures[future]
+                try:
+                    reservation = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    logger.warning('Error getting reservation %s. %s' % (code, e))
+                    continue
+                for msg in missing[code]:
+                    msg['reservation'] = reservation
+                self.reservations.put(code, missing[code][0]['status'], reservation)
+
+    @timed('send')
+    def send_message(self, thread_id, message):
         payload = {
             'message': message,
             'thread_id': thread_id
         }
-        src = self.session.post('https://api.airbnb.com/v2/messages', data=payload).text
-        body = json.loads(src)
+        body = self.api_request('POST', '/v2/messages', data=payload)
         try:
             if body['error_code']:
                 return None
@@ -288,17 +828,33 @@ class airbnbBot():
     def mark_message_read(self, thread_id):
         self.set_headers_default()
         self.login()
-        r = self.session.get('https://www.airbnb.com/z/q/' + str(thread_id))
+        r = self.session.get('https://www.airbnb.com/z/q/' + str(thread_id), timeout=self.timeout)
         if r.status_code == 200:
             return 'message marked read'
         else:
             return 'message not marked read'
 
-    def send_reply(self, thread_id, message):
+    def send_reply(self, thread_id, message, key=None):
+        """Queue a reply to a message thread, it is sent by the sender thread
+        (see start_sender). key is the reply's idempotency key, a reply with
+        the same key is only queued and sent once."""
         if testing:
             return
-        pass
-        #send_message(thread_id, message)
+        if not self.outbox.enqueue(thread_id, message, key):
+            logger.info('Reply to %s already queued or sent, skipping..' % thread_id)
+
+    def queue_mark_read(self, thread_id):
+        """Queue marking a message thread as read, repeated calls for the
+        same thread before it is marked read are sent once."""
+        self.outbox.mark_read(thread_id)
+
+    def start_sender(self):
+        """Start sending the queued replies and mark reads from a background thread.
+        The sender uses its own session so it doesn't change this bot's headers
+        while threads are being fetched."""
+        sender = airbnbBot(self.username, self.password, self.apikey, self.oauthtoken,
+                           self.api_url, timeout=self.timeout)
+        return self.outbox.start(sender, self)
 
 
 class color:
@@ -324,25 +880,208 @@ QUESTION_START_WORDS = (
 )
 
 def is_question(text):
-    sentences = get_sentences(text)
-    isquestion = False
-    for sent in sentences:
-        words = nltk.word_tokenize(sent)
-        if words[-1] == '?' or words[0].lower() in QUESTION_START_WORDS:
-            isquestion = True
-            break
-    return isquestion
+    return analyze(text).is_question
+
+# nltk stopwords corpus file ids and their language codes (ISO 639-1)
+STOPWORDS_LANGUAGES = {
+    'arabic': 'ar', 'azerbaijani': 'az', 'basque': 'eu', 'bengali': 'bn', 'catalan': 'ca',
+    'chinese': 'zh', 'danish': 'da', 'dutch': 'nl', 'english': 'en', 'finnish': 'fi',
+    'french': 'fr', 'german': 'de', 'greek': 'el', 'hebrew': 'he', 'hungarian': 'hu',
+    'indonesian': 'id', 'italian': 'it', 'kazakh': 'kk', 'nepali': 'ne', 'norwegian': 'no',
+    'portuguese': 'pt', 'romanian': 'ro', 'russian': 'ru', 'slovene': 'sl', 'spanish': 'es',
+    'swedish': 'sv', 'tajik': 'tg', 'turkish': 'tr',
+}
+
+# unicode ranges of scripts used by a single (main) language
+SCRIPT_LANGUAGES = (
+    (0x3040, 0x30ff, 'ja'),  # hiragana, katakana
+    (0xac00, 0xd7af, 'ko'),  # hangul syllables
+    (0x1100, 0x11ff, 'ko'),  # hangul jamo
+    (0x4e00, 0x9fff, 'zh'),  # cjk ideographs, also used in ja
+    (0x0400, 0x04ff, 'ru'),  # cyrillic
+    (0x0370, 0x03ff, 'el'),  # greek
+    (0x0590, 0x05ff, 'he'),  # hebrew
+    (0x0600, 0x06ff, 'ar'),  # arabic
+    (0x0900, 0x097f, 'hi'),  # devanagari
+    (0x0e00, 0x0e7f, 'th'),  # thai
+)
+
+
+class LanguageDetector():
+    """Offline language detector. Messages mostly written in a script used by
+    one language (ja, ko, zh, ru, ...) are detected by script, other messages by
+    counting the stop words of each language in the nltk stopwords corpus.
+    Returns default_language if nothing is detected (no stop words found)."""
+    def __init__(self, default_language='en'):
+        self.default_language = default_language
+        self._stop_words = None
+        self.word_re = re.compile(r"[^\W\d_]+", re.UNICODE)
+
+    @property
+    def stop_words(self):
+        # dict of word -> list of language codes, loaded on first use
+        if self._stop_words is None:
+            import nltk
+            stop_words = {}
+            for fileid in nltk.corpus.stopwords.fileids():
+                lang = STOPWORDS_LANGUAGES.get(fileid)
+                if lang is None:
+                    continue
+                for word in nltk.corpus.stopwords.words(fileid):
+                    stop_words.setdefault(word, []).append(lang)
+            self._stop_words = stop_words
+        return self._stop_words
+
+    def detect_script(self, text):
+        scripts = Counter()
+        latin = 0
+        for c in text:
+            if not c.isalpha():
+                continue
+            cp = ord(c)
+            if cp < 0x250:
+                latin += 1
+                continue
+            for start, end, lang in SCRIPT_LANGUAGES:
+                if start <= cp <= end:
+                    scripts[lang] += 1
+                    break
+        if not scripts or sum(scripts.values()) < latin:
+            return None
+        # japanese mixes kana with cjk ideographs
+        if scripts['ja'] > 0:
+            return 'ja'
+        return scripts.most_common(1)[0][0]
+
+    def detect(self, text):
+        lang = self.detect_script(text)
+        if lang is not None:
+            return lang
+        stop_words = self.stop_words
+        scores = Counter()
+        for word in self.word_re.findall(text.lower()):
+            for lang in stop_words.get(word, ()):
+                scores[lang] += 1
+        if not scores:
+            return self.default_language
+        # ties go to the default language
+        best = max(scores.values())
+        if scores[self.default_language] == best:
+            return self.default_language
+        return scores.most_common(1)[0][0]
+
+
+class TextBlobLanguageDetector():
+    """Language detector using TextBlob (Google Translate, needs network access)."""
+    def detect(self, text):
+        from textblob import TextBlob
+        return TextBlob(text).detect_language()
+
+
+LANGUAGE_DETECTORS = {
+    'local': LanguageDetector,
+    'textblob': TextBlobLanguageDetector,
+}
+
+# language detector set in config and its cache of (thread id, message) -> language
+language_detector_engine = None
+language_cache = OrderedDict()
+language_cache_lock = threading.Lock()
+
+def detect_language(text, thread_id=None):
+    """Detect the language of a message using the language detector set in config.
+    Results are cached per thread so a message is only detected once."""
+    global language_detector_engine
+    key = (thread_id, text)
+    with language_cache_lock:
+        if key in language_cache:
+            language_cache.move_to_end(key)
+            return language_cache[key]
+        if language_detector_engine is None:
+            language_detector_engine = LANGUAGE_DETECTORS[language_detector]()
+    lang = language_detector_engine.detect(text)
+    with language_cache_lock:
+        language_cache[key] = lang
+        while len(language_cache) > 1000:
+            language_cache.popitem(last=False)
+    return lang
 
 # end language function
 
 
 # text cleaning functions
 
+class TextPreprocessor():
+    """Text preprocessing shared by the text cleaning functions. Holds the
+    stop words, a lemmatizer with an LRU cache of lemmas and the punctuation
+    translate table so they are only built once."""
+    def __init__(self, lemma_cache_size=100000):
+        self.lemma_cache_size = lemma_cache_size
+        self._stop_words = None
+        self._lemmatize = None
+        self._normalize_word = None
+        self.remove_punct_table = str.maketrans('', '', string.punctuation)
+
+    @property
+    def stop_words(self):
+        # loaded on first use so importing doesn't need the nltk stopwords data
+        if self._stop_words is None:
+            import nltk
+            self._stop_words = frozenset(nltk.corpus.stopwords.words("english"))
+        return self._stop_words
+
+    @property
+    def lemmatize(self):
+        if self._lemmatize is None:
+            import nltk
+            self.lemmer = nltk.stem.WordNetLemmatizer()
+            self._lemmatize = lru_cache(maxsize=self.lemma_cache_size)(self.lemmer.lemmatize)
+        return self._lemmatize
+
+    def word_tokenize(self, text):
+        import nltk
+        return nltk.word_tokenize(text)
+
+    def lem_tokens(self, tokens):
+        lemmatize = self.lemmatize
+        return [lemmatize(token) for token in tokens]
+
+    def lem_normalize(self, text):
+        return self.lem_tokens(self.word_tokenize(text.lower().translate(self.remove_punct_table)))
+
+    @property
+    def normalize_word(self):
+        """lem_normalize of a single word as a tuple, with an LRU cache"""
+        if self._normalize_word is None:
+            self._normalize_word = lru_cache(maxsize=self.lemma_cache_size)(
+                lambda word: tuple(self.lem_normalize(word)))
+        return self._normalize_word
+
+    def lem_normalize_words(self, words):
+        """Same as lem_normalize of the words joined with spaces (with punctuation
+        removed the tokenizer doesn't split across spaces), each word is only
+        tokenized and lemmatized the first time it is seen."""
+        normalize_word = self.normalize_word
+        return [lemma for word in words for lemma in normalize_word(word)]
+
+
+preprocessor = TextPreprocessor()
+
+def warm_up():
+    """Load the nltk data the text cleaning functions use (tokenizers, stop words
+    and wordnet). nltk loads its data lazily and that isn't thread safe, so this
+    is called before several threads process messages at the same time."""
+    preprocessor.stop_words
+    preprocessor.lemmatize('rooms')
+    preprocessor.word_tokenize('warm up')
+    get_sentences('warm up. done')
+
 def get_sentences(text):
     """Retrieve the sentences present in a given string of text.
     The return value is a list of sentences."""
     text = text.split('.')
     text = '. '.join(text).strip()
+    import nltk
     sentList = nltk.sent_tokenize(text)
     return sentList
 
@@ -351,44 +1090,111 @@ def get_words(text):
     Filter out the most common and stop words.
     The return value is a list of tuples where the first member is a lowercase word,
     and the second member the number of time it is present in the text."""
-    wordsList = nltk.word_tokenize(text)
+    return analyze(text).words
+
+def words_from_tokens(tokens):
+    """Filter and lemmatize word tokens for get_words."""
+    wordsList = list(tokens)
     # remove most common words
-    fdist = nltk.probability.FreqDist(wordsList)
-    most_common_words = fdist.most_common(2)
+    most_common_words = Counter(wordsList).most_common(2)
     for word, count in most_common_words:
         word = word.lower()
         if word in wordsList:
             wordsList.remove(word)
     # remove stop words
-    stop_words = nltk.corpus.stopwords.words("english")
-    filtered_wordsList = []
-    for word in wordsList:
-        word = word.lower()
-        if word not in stop_words:
-            filtered_wordsList.append(word)
-    wordsList = filtered_wordsList[:]
-    del filtered_wordsList[:]
+    stop_words = preprocessor.stop_words
+    wordsList = [word for word in (word.lower() for word in wordsList) if word not in stop_words]
     # perform lemmatization
-    text = " ".join(wordsList)
-    filtered_wordsList = lem_normalize(text)
+    filtered_wordsList = preprocessor.lem_normalize_words(wordsList)
     return Counter(filtered_wordsList).items()
 
 def clean_words(text):
     """Simple text cleaner that removes all tokens that are not alphabetic
     Returns list of clean words."""
-    text = text.split('.')
-    text = '. '.join(text).strip()
-    words = nltk.word_tokenize(text)
-    words_clean = [word for word in words if word.isalpha()]
-    return words_clean
+    return analyze(text).clean_words
 
 def lem_tokens(tokens):
-    lemmer = nltk.stem.WordNetLemmatizer()
-    return [lemmer.lemmatize(token) for token in tokens]
+    return preprocessor.lem_tokens(tokens)
 
 def lem_normalize(text):
-    remove_punct_dict = dict((ord(punct), None) for punct in string.punctuation)
-    return lem_tokens(nltk.word_tokenize(text.lower().translate(remove_punct_dict)))
+    return preprocessor.lem_normalize_words(text.split())
+
+
+class MessageAnalysis():
+    """Analysis of a guest message (sentences, tokens, clean words, lemmas,
+    word counts and question flag). Each part is computed once on first use
+    so the reply functions don't tokenize the same message again."""
+    def __init__(self, text):
+        self.text = text
+        self._sentences = None
+        self._sentence_tokens = None
+        self._word_tokens = None
+        self._clean_words = None
+        self._lemmas = None
+        self._words = None
+        self._is_question = None
+
+    @property
+    def sentences(self):
+        if self._sentences is None:
+            self._sentences = get_sentences(self.text)
+        return self._sentences
+
+    @property
+    def sentence_tokens(self):
+        """list of word tokens for each sentence"""
+        if self._sentence_tokens is None:
+            self._sentence_tokens = [preprocessor.word_tokenize(sent) for sent in self.sentences]
+        return self._sentence_tokens
+
+    @property
+    def tokens(self):
+        return [word for words in self.sentence_tokens for word in words]
+
+    @property
+    def word_tokens(self):
+        """word tokens of the text as is (not split into sentences), used for the words"""
+        if self._word_tokens is None:
+            self._word_tokens = preprocessor.word_tokenize(self.text)
+        return self._word_tokens
+
+    @property
+    def clean_words(self):
+        """tokens that are alphabetic"""
+        if self._clean_words is None:
+            self._clean_words = [word for word in self.tokens if word.isalpha()]
+        return self._clean_words
+
+    @property
+    def lemmas(self):
+        """lemmas as tokenized by the corpus tfidf vectorizer"""
+        if self._lemmas is None:
+            self._lemmas = lem_normalize(self.text)
+        return self._lemmas
+
+    @property
+    def words(self):
+        """(word, count) tuples without most common and stop words, see get_words"""
+        if self._words is None:
+            self._words = words_from_tokens(self.word_tokens)
+        return self._words
+
+    @property
+    def is_question(self):
+        if self._is_question is None:
+            self._is_question = False
+            for words in self.sentence_tokens:
+                if words and (words[-1] == '?' or words[0].lower() in QUESTION_START_WORDS):
+                    self._is_question = True
+                    break
+        return self._is_question
+
+
+def analyze(text):
+    """Return the MessageAnalysis for text, text can also already be a MessageAnalysis."""
+    if isinstance(text, MessageAnalysis):
+        return text
+    return MessageAnalysis(text)
 
 # end text cleaning
 
@@ -399,20 +1205,19 @@ def get_id(entityName, text):
     """Retrieve an entity's unique ID from the database, given its associated text.
     If the row is not already present, it is inserted.
     The entity can either be a sentence or a word."""
-    tableName = entityName + 's'
-    columnName = entityName
-    cursor.execute('SELECT rowid FROM ' + tableName + ' WHERE ' + columnName + ' = ?', (text,))
-    row = cursor.fetchone()
+    statements = ENTITY_STATEMENTS[entityName]
+    ctx.cursor.execute(statements['select'], (text,))
+    row = ctx.cursor.fetchone()
     if row:
         return row[0], True
     else:
-        cursor.execute('INSERT INTO ' + tableName + ' (' + columnName + ') VALUES (?)', (text,))
-        return cursor.lastrowid, False
+        ctx.cursor.execute(statements['insert'], (text,))
+        return ctx.cursor.lastrowid, False
 
 def in_database(response):
     """Check if Tobot has the response stored in database."""
-    cursor.execute('SELECT rowid FROM sentences WHERE sentence = ?', (response,))
-    row = cursor.fetchone()
+    ctx.cursor.execute(ENTITY_STATEMENTS['sentence']['select'], (response,))
+    row = ctx.cursor.fetchone()
     if row:
         return True
     else:
@@ -432,71 +1237,770 @@ def train_bot(H, B):
             return None
     words = get_words(H)
     words_length = sum([n * len(word) for word, n in words])
+    # inside a ProcessedThreads transaction (training from a thread) it commits the training
+    in_transaction = ctx.connection.in_transaction
     sentence_id, in_db = get_id('sentence', B)
     if in_db:
         return 'already in db'
+    associations = []
     for word, n in words:
         word_id, in_db = get_id('word', word)
         weight = sqrt(n / float(words_length))
-        cursor.execute('INSERT INTO associations VALUES (?, ?, ?)', (word_id, sentence_id, weight))
-    connection.commit()
+        ctx.cursor.execute('INSERT INTO associations VALUES (?, ?, ?)', (word_id, sentence_id, weight))
+        associations.append((word, weight))
+    generation = bump_brain_generation()
+    if not in_transaction:
+        ctx.connection.commit()
+    # keep the in-memory brain in sync
+    if ctx.brain_matrix is not None:
+        ctx.brain_matrix.add(sentence_id, B, associations)
+        ctx.brain_matrix.synced(generation)
     return 'success'
 
-def brain_dump(sizeonly=False):
-    """Print what's in bot's brain (db)."""
-    cursor.execute('SELECT * FROM sentences')
-    rows_sent = cursor.fetchall()
-    cursor.execute('SELECT * FROM words')
-    rows_words = cursor.fetchall()
-    cursor.execute('SELECT * FROM associations')
-    rows_assoc = cursor.fetchall()
-    if sizeonly:
-        return 'TOBOT: BRAIN(db) (sentences: %s, words: %s)' % (len(rows_sent), len(rows_words))
-    else:
-        if not rows_sent:
-            print("sentences empty")
+def get_brain_generation(connection):
+    """Return the brain generation, a counter that goes up every time Tobot learns
+    something. It is kept in the database so the brain cli's training is seen too."""
+    row = connection.execute("SELECT value FROM brain_meta WHERE name = 'generation'").fetchone()
+    if row is None:
+        return 0
+    return row[0]
+
+def bump_brain_generation():
+    """Increase the brain generation, committed with the training's transaction.
+    Returns the new generation."""
+    ctx.cursor.execute("INSERT OR IGNORE INTO brain_meta VALUES ('generation', 0)")
+    ctx.cursor.execute("UPDATE brain_meta SET value = value + 1 WHERE name = 'generation'")
+    return get_brain_generation(ctx.connection)
+
+class ProcessedThreads():
+    """Persistent store (db) of the message threads Tobot has processed, keyed by
+    thread id and thread version so a thread is processed again only when it changes.
+    The most recently used threads are kept in an in-memory LRU cache."""
+    def __init__(self, connection, cache_size=10000, ttl=2592000):
+        self.connection = connection
+        self.cache_size = cache_size
+        self.ttl = ttl  # seconds to keep processed threads in db
+        self.cache = OrderedDict()  # thread id -> version
+        self.in_transaction = False
+        self.uncommitted = []  # (thread id, version) added in the open transaction
+
+    def seen(self, thread_id, version):
+        """Check if the thread was already processed at this version."""
+        if thread_id in self.cache:
+            self.cache.move_to_end(thread_id)
+            return self.cache[thread_id] == str(version)
+        row = self.connection.execute('SELECT version FROM processed_threads WHERE thread_id = ?',
+                                      (thread_id,)).fetchone()
+        if row is None:
+            return False
+        self.cache_put(thread_id, row[0])
+        return row[0] == str(version)
+
+    def add_many(self, threads):
+        """Mark many (thread id, version) threads as processed in one transaction."""
+        now = time.time()
+        self.connection.executemany('INSERT OR REPLACE INTO processed_threads VALUES (?, ?, ?)',
+                                    [(thread_id, str(version), now) for thread_id, version in threads])
+        self.connection.executemany('DELETE FROM retry_threads WHERE thread_id = ?',
+                                    [(thread_id,) for thread_id, version in threads])
+        self.connection.commit()
+        for thread_id, version in threads:
+            self.cache_put(thread_id, str(version))
+
+    def add(self, thread_id, version):
+        """Mark the thread as processed at this version."""
+        self.connection.execute('INSERT OR REPLACE INTO processed_threads VALUES (?, ?, ?)',
+                                (thread_id, str(version), time.time()))
+        self.connection.execute('DELETE FROM retry_threads WHERE thread_id = ?', (thread_id,))
+        if self.in_transaction:
+            self.uncommitted.append((thread_id, str(version)))
+            return
+        self.connection.commit()
+        self.cache_put(thread_id, str(version))
+
+    def retry(self, messages):
+        """Keep the thread list messages of new threads until their threads are
+        processed (add), so a thread that fails isn't lost when the next inbox
+        check stops paging at a newer processed thread."""
+        now = time.time()
+        for message in messages:
+            text = json.dumps(message)
+            self.connection.execute('UPDATE retry_threads SET message = ? WHERE thread_id = ?',
+                                    (text, message['id']))
+            self.connection.execute('INSERT OR IGNORE INTO retry_threads VALUES (?, ?, ?)',
+                                    (message['id'], text, now))
+        self.connection.commit()
+
+    def retries(self):
+        """Return the thread list messages of the threads still to be processed, oldest first."""
+        rows = self.connection.execute('SELECT message FROM retry_threads ORDER BY added_at').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    @contextmanager
+    def transaction(self):
+        """Record processed threads (add, set_cursor) together with the replies
+        queued for them (Outbox) in one transaction, committed when the block
+        finishes. If the block raises nothing is recorded, so the thread is
+        processed again on the next inbox check and no reply is lost.
+        The write lock is taken up front (BEGIN IMMEDIATE, waiting db_busy_timeout)
+        so a commit by another connection can't make a later write in the block
+        fail with 'database is locked'. Functions called in the block don't commit
+        while the transaction is open."""
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.in_transaction = True
+        try:
+            yield
+        except BaseException:
+            self.connection.rollback()
+            raise
         else:
-            print("sentences: ")
-            for row in rows_sent:
-                print(row)
-        if not rows_words:
-            print("words empty")
+            self.connection.commit()
+            for thread_id, version in self.uncommitted:
+                self.cache_put(thread_id, version)
+        finally:
+            self.in_transaction = False
+            self.uncommitted = []
+
+    def get_cursor(self, thread_id):
+        """Return a tuple with the thread's last processed post id (None if the
+        thread has no cursor) and if the host posted in the thread."""
+        row = self.connection.execute('SELECT last_post_id, host_replied FROM thread_cursors WHERE thread_id = ?',
+                                      (thread_id,)).fetchone()
+        if row is None:
+            return None, False
+        return row[0], bool(row[1])
+
+    def set_cursor(self, thread_id, last_post_id, host_replied):
+        """Move the thread's cursor to last_post_id."""
+        self.connection.execute('INSERT OR REPLACE INTO thread_cursors VALUES (?, ?, ?)',
+                                (thread_id, last_post_id, int(host_replied)))
+        if not self.in_transaction:
+            self.connection.commit()
+
+    def cache_put(self, thread_id, version):
+        self.cache[thread_id] = version
+        self.cache.move_to_end(thread_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def prune(self):
+        """Remove threads processed (or waiting for a retry) longer than ttl seconds ago."""
+        self.connection.execute('DELETE FROM retry_threads WHERE added_at < ?', (time.time() - self.ttl,))
+        cur = self.connection.execute('DELETE FROM processed_threads WHERE processed_at < ?',
+                                      (time.time() - self.ttl,))
+        if cur.rowcount > 0:
+            self.connection.execute('DELETE FROM thread_cursors WHERE thread_id NOT IN '
+                                    '(SELECT thread_id FROM processed_threads)')
+        self.connection.commit()
+        if cur.rowcount > 0:
+            self.cache.clear()
+        return cur.rowcount
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM processed_threads').fetchone()[0]
+
+
+class ReservationCache():
+    """Reservations by confirmation code, kept in memory for ttl seconds. A reservation
+    is looked up again sooner if the status of its message thread changes."""
+    def __init__(self, size=10000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # confirmation code -> (fetched at, thread status, reservation)
+        self.lock = threading.Lock()
+
+    def get(self, code, status):
+        """Return a tuple with True and the cached reservation (can be None if Airbnb
+        didn't find it) if it is cached for the thread status, else (False, None)."""
+        with self.lock:
+            entry = self.entries.get(code)
+            if entry is not None and entry[1] == status and time.time() - entry[0] < self.ttl:
+                self.entries.move_to_end(code)
+                metrics.inc('reservation_cache_hits')
+                return True, entry[2]
+        metrics.inc('reservation_cache_misses')
+        return False, None
+
+    def put(self, code, status, reservation):
+        with self.lock:
+            self.entries[code] = (time.time(), status, reservation)
+            self.entries.move_to_end(code)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+class TokenBucket():
+    """Rate limiter that allows rate calls per second on average
+    with bursts of up to burst calls."""
+    def __init__(self, rate=0.5, burst=3):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait(self):
+        """Wait until a call is allowed."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+class Outbox():
+    """Durable queue of replies to send and message threads to mark as read for
+    an account, kept in the outbox table of the brain (db) so nothing is lost if
+    Tobot stops. A sender thread (see start) sends them at most rate per second,
+    retrying failures max_attempts times with exponential backoff. Each reply has
+    an idempotency key so it is only queued once, and sent replies are kept for
+    processed_ttl_days. Replies that may have been sent before a crash or failed
+    request are checked against the thread's posts before they are sent again."""
+    def __init__(self, db, account='', rate=0.5, burst=3, max_attempts=5, retry_backoff=30):
+        # the sender thread and the bot's threads each use their own connection of the BrainPool
+        self.db = db
+        self.account = account
+        self.bucket = TokenBucket(rate, burst)
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+    def enqueue(self, thread_id, message, key=None):
+        """Queue a reply, returns False if a reply with the same key was already queued."""
+        if key is None:
+            key = '%s:%s' % (thread_id, hashlib.sha1(message.encode('utf-8')).hexdigest())
+        now = time.time()
+        # inside a ProcessedThreads transaction the reply is committed with the thread
+        in_transaction = self.db.connection.in_transaction
+        cur = self.db.connection.execute('INSERT OR IGNORE INTO outbox (account, key, kind, thread_id, message, '
+                                         'status, next_attempt, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                         (self.account, 'reply:' + key, 'reply', thread_id, message, 'queued', now, now))
+        if not in_transaction:
+            self.db.connection.commit()
+        self.wakeup.set()
+        return cur.rowcount > 0
+
+    def mark_read(self, thread_id):
+        """Queue marking a thread as read, coalesced with a queued one for the same thread."""
+        now = time.time()
+        in_transaction = self.db.connection.in_transaction
+        self.db.connection.execute('INSERT OR IGNORE INTO outbox (account, key, kind, thread_id, '
+                                   'status, next_attempt, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (self.account, 'read:%s' % thread_id, 'read', thread_id, 'queued', now, now))
+        if not in_transaction:
+            self.db.connection.commit()
+        self.wakeup.set()
+
+    def due(self, limit=50):
+        """Return the queued (id, kind, thread_id, message, attempts) rows that are due to be sent."""
+        return self.db.connection.execute('SELECT id, kind, thread_id, message, attempts FROM outbox '
+                                          'WHERE account = ? AND status = ? AND next_attempt <= ? '
+                                          'ORDER BY id LIMIT ?',
+                                          (self.account, 'queued', time.time(), limit)).fetchall()
+
+    def set_status(self, rowid, status, attempts=0, next_attempt=0):
+        self.db.connection.execute('UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, '
+                                   'sent_at = CASE WHEN ? = ? THEN ? END WHERE id = ?',
+                                   (status, attempts, next_attempt, status, 'sent', time.time(), rowid))
+        self.db.connection.commit()
+
+    def already_sent(self, sender, thread_id, message):
+        """Check if a reply is in the newest posts of its thread."""
+        mt = sender.get_message_thread(thread_id, limit=10)
+        return mt is not None and any(post['message'] == message for post in mt['posts'])
+
+    def send(self, sender, bot, row):
+        """Send a queued reply or mark a thread as read, rescheduling it on failure."""
+        rowid, kind, thread_id, message, attempts = row
+        try:
+            if kind == 'reply':
+                if attempts > 0 and self.already_sent(sender, thread_id, message):
+                    ok = True
+                else:
+                    # if Tobot stops during the request the reply is checked at start up
+                    self.set_status(rowid, 'sending', attempts)
+                    ok = sender.send_message(thread_id, message) is not None
+            else:
+                ok = sender.mark_message_read(thread_id) == 'message marked read'
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning('Error sending to message thread %s. %s' % (thread_id, e))
+            ok = False
+        except Exception as e:
+            # any other error (database locked, unexpected response) is retried too
+            logger.exception('Error sending to message thread %s. %s' % (thread_id, e))
+            ok = False
+        attempts += 1
+        if ok:
+            if kind == 'reply':
+                self.set_status(rowid, 'sent', attempts)
+                metrics.inc('replies_sent')
+            else:
+                self.db.connection.execute('DELETE FROM outbox WHERE id = ?', (rowid,))
+                self.db.connection.commit()
+                bot.message_count_processed += 1
+        elif attempts >= self.max_attempts:
+            logger.warning('Giving up sending to message thread %s after %s attempts' % (thread_id, attempts))
+            metrics.inc('send_failures')
+            if kind == 'reply':
+                self.set_status(rowid, 'failed', attempts)
+            else:
+                self.db.connection.execute('DELETE FROM outbox WHERE id = ?', (rowid,))
+                self.db.connection.commit()
         else:
-            print("words: ")
-            for row in rows_words:
-                print(row)
-        if not rows_assoc:
-            print("associations empty")
+            metrics.inc('send_retries')
+            self.set_status(rowid, 'queued', attempts, time.time() + self.retry_backoff * 2 ** (attempts - 1))
+
+    def recover(self):
+        """Queue again the replies that were being sent when Tobot stopped,
+        they are checked against the thread's posts before sending."""
+        self.db.connection.execute('UPDATE outbox SET status = ?, attempts = MAX(attempts, 1) '
+                                   'WHERE account = ? AND status = ?', ('queued', self.account, 'sending'))
+        self.db.connection.commit()
+
+    def prune(self):
+        """Forget sent and failed replies older than processed_ttl_days."""
+        self.db.connection.execute('DELETE FROM outbox WHERE account = ? AND status IN (?, ?) AND created_at < ?',
+                                   (self.account, 'sent', 'failed', time.time() - processed_ttl_days * 86400))
+        self.db.connection.commit()
+
+    def run(self, sender, bot):
+        recover = True
+        pruned_at = 0
+        while not self.stopped.is_set():
+            try:
+                if recover:
+                    self.recover()
+                    recover = False
+                if time.time() - pruned_at > 3600:
+                    self.prune()
+                    pruned_at = time.time()
+                rows = self.due()
+                for row in rows:
+                    self.bucket.wait()
+                    self.send(sender, bot, row)
+                if rows:
+                    continue
+                # sleep until the next retry is due or a new reply is queued
+                row = self.db.connection.execute('SELECT MIN(next_attempt) FROM outbox WHERE account = ? AND status = ?',
+                                                 (self.account, 'queued')).fetchone()
+                timeout = 60 if row[0] is None else min(60, max(0, row[0] - time.time()))
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+            except Exception as e:
+                # keep the sender running (the brain cli may have the database locked),
+                # a reply left in 'sending' is checked and queued again by recover
+                logger.exception('Error in outbox sender for %s. %s' % (self.account or 'account', e))
+                metrics.inc('send_errors')
+                try:
+                    self.db.connection.rollback()
+                except Exception:
+                    pass
+                recover = True
+                self.stopped.wait(5)
+
+    def start(self, sender, bot):
+        """Start the sender thread, sending with sender and counting on bot."""
+        thread = threading.Thread(target=self.run, args=(sender, bot), name='tobot-sender')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def __len__(self):
+        """Number of queued replies and mark reads."""
+        return self.db.connection.execute('SELECT COUNT(*) FROM outbox WHERE account = ? AND status IN (?, ?)',
+                                          (self.account, 'queued', 'sending')).fetchone()[0]
+
+def select_ids(entityName, texts):
+    """Retrieve the unique IDs of many entities (sentences or words) from the database.
+    Returns a dict of text -> rowid for the rows that are present."""
+    texts = list(texts)
+    ids = {}
+    # stay below sqlite's limit of host parameters per statement
+    for i in range(0, len(texts), 500):
+        chunk = texts[i:i + 500]
+        sql = ENTITY_STATEMENTS[entityName]['select_many'] % ', '.join(['?'] * len(chunk))
+        for rowid, text in ctx.cursor.execute(sql, chunk):
+            ids[text] = rowid
+    return ids
+
+def train_batch(pairs):
+    """Add a batch of (human question, bot response) pairs into the database
+    in one transaction. Returns number of pairs added."""
+    existing = select_ids('sentence', set(B for H, B in pairs))
+    new_pairs = []
+    seen = set()
+    for H, B in pairs:
+        if B in existing or B in seen:
+            continue
+        seen.add(B)
+        new_pairs.append((H, get_words(H), B))
+    if not new_pairs:
+        return 0
+    ctx.cursor.executemany(ENTITY_STATEMENTS['sentence']['insert'], [(B,) for H, words, B in new_pairs])
+    sentence_ids = select_ids('sentence', [B for H, words, B in new_pairs])
+    all_words = set(word for H, words, B in new_pairs for word, n in words)
+    ctx.cursor.executemany(ENTITY_STATEMENTS['word']['insert_or_ignore'], [(word,) for word in all_words])
+    word_ids = select_ids('word', all_words)
+    rows = []
+    for H, words, B in new_pairs:
+        words_length = sum([n * len(word) for word, n in words])
+        associations = []
+        for word, n in words:
+            weight = sqrt(n / float(words_length))
+            rows.append((word_ids[word], sentence_ids[B], weight))
+            associations.append((word, weight))
+        # keep the in-memory brain in sync
+        if ctx.brain_matrix is not None:
+            ctx.brain_matrix.add(sentence_ids[B], B, associations)
+    ctx.cursor.executemany('INSERT INTO associations VALUES (?, ?, ?)', rows)
+    generation = bump_brain_generation()
+    ctx.connection.commit()
+    if ctx.brain_matrix is not None:
+        ctx.brain_matrix.synced(generation)
+    return len(new_pairs)
+
+def train_bot_many(pairs, batch_size=1000):
+    """Train Tobot with many (human question, bot response) pairs at once.
+    Pairs are committed to the database in transactions of batch_size pairs.
+    Returns a tuple with number of pairs added and pairs already in db."""
+    added = 0
+    total = 0
+    batch = []
+    for H, B in pairs:
+        H = H.strip()
+        B = B.strip()
+        if H == '' or B == '':
+            continue
+        batch.append((H, B))
+        if len(batch) >= batch_size:
+            added += train_batch(batch)
+            total += len(batch)
+            del batch[:]
+    if batch:
+        added += train_batch(batch)
+        total += len(batch)
+    return added, total - added
+
+def text_field(row, key, filename, line):
+    """Return the text value of key in a row read from filename, raising
+    ValueError if the row has no text value for key."""
+    value = row.get(key) if isinstance(row, dict) else None
+    if not isinstance(value, str):
+        raise ValueError('%s line %s: no text %s' % (filename, line, key))
+    return value
+
+def read_training_pairs(filename):
+    """Read (human question, bot response) pairs from a jsonl file
+    with question and response keys, or a csv file with a
+    question,response header. Raises ValueError on a row without
+    a text question or response."""
+    with open(filename, 'r', errors='ignore') as f:
+        if filename.endswith('.csv'):
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield (text_field(row, 'question', filename, reader.line_num),
+                       text_field(row, 'response', filename, reader.line_num))
         else:
-            print("associations: ")
-            for row in rows_assoc:
-                print(row)
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if line == '':
+                    continue
+                row = json.loads(line)
+                yield (text_field(row, 'question', filename, n),
+                       text_field(row, 'response', filename, n))
+
+BRAIN_TABLES = ('sentences', 'words', 'associations')
+
+def brain_size():
+    """Return a dict with the number of rows in each brain (db) table."""
+    return dict((table, ctx.connection.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0])
+                for table in BRAIN_TABLES)
+
+def brain_rows(table, word=None, sentence=None, top=None):
+    """Stream rows of a brain (db) table. word only keeps rows (words, associations) of
+    that word, sentence only keeps rows (sentences, associations) with sentences containing
+    that text and top keeps the top rows (the most used sentences or the associations with
+    the highest weight). Raises ValueError for a filter the table doesn't have.
+    Returns a tuple with the column names and an iterator over the rows."""
+    where = []
+    params = []
+    if table == 'sentences':
+        if word is not None:
+            raise ValueError('sentences can not be filtered by word')
+        columns = ('rowid', 'sentence', 'used')
+        sql = 'SELECT rowid, sentence, used FROM sentences'
+        if sentence is not None:
+            where.append('sentence LIKE ?')
+            params.append('%' + sentence + '%')
+        order = ' ORDER BY used DESC'
+    elif table == 'words':
+        if sentence is not None:
+            raise ValueError('words can not be filtered by sentence')
+        if top is not None:
+            raise ValueError('words have no top rows')
+        columns = ('rowid', 'word')
+        sql = 'SELECT rowid, word FROM words'
+        if word is not None:
+            where.append('word = ?')
+            params.append(word)
+        order = ''
+    elif table == 'associations':
+        columns = ('word_id', 'word', 'sentence_id', 'sentence', 'weight')
+        sql = ('SELECT associations.word_id, words.word, associations.sentence_id, sentences.sentence, '
+               'associations.weight FROM associations '
+               'LEFT JOIN words ON words.rowid = associations.word_id '
+               'LEFT JOIN sentences ON sentences.rowid = associations.sentence_id')
+        if word is not None:
+            where.append('associations.word_id = (SELECT rowid FROM words WHERE word = ?)')
+            params.append(word)
+        if sentence is not None:
+            where.append('sentences.sentence LIKE ?')
+            params.append('%' + sentence + '%')
+        order = ' ORDER BY associations.weight DESC'
+    else:
+        raise ValueError('unknown brain table %s' % table)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    if top is not None:
+        # sqlite keeps only the top rows while sorting
+        sql += order + ' LIMIT %d' % int(top)
+    return columns, ctx.connection.execute(sql, params)
+
+def brain_stats(top=10):
+    """Return statistics about bot's brain (db); table sizes, associations per
+    sentence and word, average weight and the top words with the most associations."""
+    stats = brain_size()
+    # each distinct count scans its covering index instead of building a temp b-tree
+    assoc_sentences = ctx.connection.execute(
+        'SELECT COUNT(*) FROM (SELECT DISTINCT sentence_id FROM associations)').fetchone()[0]
+    assoc_words = ctx.connection.execute(
+        'SELECT COUNT(*) FROM (SELECT DISTINCT word_id FROM associations)').fetchone()[0]
+    avg_weight, max_weight = ctx.connection.execute('SELECT AVG(weight), MAX(weight) FROM associations').fetchone()
+    stats['associations_per_sentence'] = round(stats['associations'] / assoc_sentences, 2) if assoc_sentences else 0
+    stats['associations_per_word'] = round(stats['associations'] / assoc_words, 2) if assoc_words else 0
+    stats['avg_weight'] = round(avg_weight, 4) if avg_weight is not None else 0
+    stats['max_weight'] = round(max_weight, 4) if max_weight is not None else 0
+    stats['top_words'] = [(word, count) for word, count in ctx.connection.execute(
+        'SELECT words.word, COUNT(*) AS n FROM associations '
+        'JOIN words ON words.rowid = associations.word_id '
+        'GROUP BY associations.word_id ORDER BY n DESC LIMIT ?', (top,))]
+    return stats
+
+def write_rows(columns, rows, filename=None):
+    """Write rows to a .jsonl (one json object per row) or .csv file, or print
+    them if filename is None. Rows are written as they are read so memory use
+    doesn't grow with the number of rows. Returns the number of rows written."""
+    count = 0
+    if filename is None:
+        for row in rows:
+            print(row)
+            count += 1
+        return count
+    with open(filename, 'w', newline='') as f:
+        if filename.endswith('.csv'):
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row))) + '\n')
+                count += 1
+    return count
 
+def brain_dump(sizeonly=False):
+    """Print what's in bot's brain (db), rows are streamed from the database.
+    If sizeonly is True the size of the brain is returned instead."""
+    if sizeonly:
+        size = brain_size()
+        return 'TOBOT: BRAIN(db) (sentences: %s, words: %s)' % (size['sentences'], size['words'])
+    for table in BRAIN_TABLES:
+        columns, rows = brain_rows(table)
+        row = rows.fetchone()
+        if row is None:
+            print("%s empty" % table)
+            continue
+        print("%s: " % table)
+        print(row)
+        write_rows(columns, rows)
+
+class BrainMatrix():
+    """In-memory copy of the brain (db) associations table as a sparse
+    word x sentence weight matrix, used by the 'matrix' brain engine."""
+    def __init__(self):
+        from scipy.sparse import csr_matrix
+        self.word_rows = {}  # word -> matrix row
+        self.sentence_cols = {}  # sentence rowid -> matrix column
+        self.sentence_ids = []  # matrix column -> sentence rowid
+        self.sentences = []  # matrix column -> sentence text
+        self.matrix = csr_matrix((0, 0))
+        # (row, col, weight) added by train_bot since matrix was last built
+        self.pending = []
+        # brain generation the matrix is up to date with
+        self.generation = None
+
+    def load(self, cursor):
+        """Load all the words, sentences and associations from the database."""
+        from scipy.sparse import coo_matrix
+        # read before the tables, training done while loading causes a reload
+        self.generation = get_brain_generation(cursor.connection)
+        for rowid, sentence in cursor.execute('SELECT rowid, sentence FROM sentences'):
+            self.sentence_cols[rowid] = len(self.sentence_ids)
+            self.sentence_ids.append(rowid)
+            self.sentences.append(sentence)
+        word_ids = {}
+        for rowid, word in cursor.execute('SELECT rowid, word FROM words'):
+            word_ids[rowid] = self.word_row(word)
+        rows = []
+        cols = []
+        weights = []
+        for word_id, sentence_id, weight in cursor.execute('SELECT word_id, sentence_id, weight FROM associations'):
+            if word_id not in word_ids or sentence_id not in self.sentence_cols:
+                continue
+            rows.append(word_ids[word_id])
+            cols.append(self.sentence_cols[sentence_id])
+            weights.append(weight)
+        # duplicate associations are summed like in the sql lookup
+        self.matrix = coo_matrix((weights, (rows, cols)),
+                                 shape=(len(self.word_rows), len(self.sentences))).tocsr()
+        self.matrix.sum_duplicates()
+
+    def word_row(self, word):
+        row = self.word_rows.get(word)
+        if row is None:
+            row = self.word_rows[word] = len(self.word_rows)
+        return row
+
+    def add(self, sentence_id, sentence, associations):
+        """Add a new sentence and its (word, weight) associations."""
+        col = self.sentence_cols[sentence_id] = len(self.sentence_ids)
+        self.sentence_ids.append(sentence_id)
+        self.sentences.append(sentence)
+        for word, weight in associations:
+            self.pending.append((self.word_row(word), col, weight))
+
+    def synced(self, generation):
+        """Record that this process's training moved the brain to generation.
+        If the brain was also trained somewhere else (brain cli) since the matrix
+        was loaded, the generation isn't updated so the matrix gets reloaded."""
+        if self.generation == generation - 1:
+            self.generation = generation
+
+    def merge_pending(self):
+        """Fold the associations added since the last lookup into the matrix."""
+        from scipy.sparse import coo_matrix
+        shape = (len(self.word_rows), len(self.sentences))
+        rows, cols, weights = zip(*self.pending) if self.pending else ((), (), ())
+        self.matrix.resize(shape)
+        self.matrix = (self.matrix + coo_matrix((weights, (rows, cols)), shape=shape)).tocsr()
+        self.pending = []
+
+    def lookup_many(self, queries):
+        """Score all sentences against many query (word, weight) lists with one
+        sparse matrix product. Returns a list with None or a tuple with sentence
+        rowid, sentence text and weight for each query."""
+        from scipy.sparse import coo_matrix
+        if self.pending or self.matrix.shape != (len(self.word_rows), len(self.sentences)):
+            self.merge_pending()
+        rows = []
+        cols = []
+        weights = []
+        for qid, query in enumerate(queries):
+            for word, weight in query:
+                col = self.word_rows.get(word)
+                if col is not None:
+                    rows.append(qid)
+                    cols.append(col)
+                    weights.append(weight)
+        q = coo_matrix((weights, (rows, cols)), shape=(len(queries), len(self.word_rows))).tocsr()
+        scores = (q * self.matrix).tocsr()
+        results = []
+        for qid in range(len(queries)):
+            start, end = scores.indptr[qid], scores.indptr[qid + 1]
+            if start == end:
+                results.append(None)
+                continue
+            i = start + scores.data[start:end].argmax()
+            if scores.data[i] <= 0:
+                results.append(None)
+                continue
+            col = scores.indices[i]
+            results.append((self.sentence_ids[col], self.sentences[col], float(scores.data[i])))
+        return results
+
+    def lookup(self, query):
+        """Score all sentences against the query (word, weight) list.
+        Returns None if there is no match else a tuple with
+        sentence rowid, sentence text and weight."""
+        import numpy as np
+        if self.pending or self.matrix.shape != (len(self.word_rows), len(self.sentences)):
+            self.merge_pending()
+        rows = []
+        weights = []
+        for word, weight in query:
+            row = self.word_rows.get(word)
+            if row is not None:
+                rows.append(row)
+                weights.append(weight)
+        if not rows:
+            return None
+        scores = self.matrix[rows].T.dot(np.array(weights))
+        col = scores.argmax()
+        if scores[col] <= 0:
+            return None
+        return self.sentence_ids[col], self.sentences[col], float(scores[col])
+
+
+def get_brain_matrix():
+    """Return the in-memory brain matrix, loading it from the database on first use
+    and reloading it when the brain was trained by another process (brain cli)."""
+    if ctx.brain_matrix is None or ctx.brain_matrix.generation != get_brain_generation(ctx.connection):
+        matrix = BrainMatrix()
+        matrix.load(ctx.cursor)
+        ctx.brain_matrix = matrix
+    return ctx.brain_matrix
+
+def db_lookup_sql(query):
+    """Score the query (word, weight) list against the brain (db) with sql.
+    Returns None if there is no match else a tuple with
+    sentence rowid, sentence text and weight."""
+    # the query words and their weights are joined in as a VALUES table and scored in one query
+    params = []
+    for word, weight in query:
+        params += [word, weight]
+    ctx.cursor.execute('WITH query(word, weight) AS (VALUES ' + ', '.join(['(?, ?)'] * len(query)) + ') '
+                   'SELECT associations.sentence_id, sentences.sentence, SUM(query.weight*associations.weight) AS sum_weight '
+                   'FROM query INNER JOIN words ON words.word=query.word '
+                   'INNER JOIN associations ON associations.word_id=words.rowid '
+                   'INNER JOIN sentences ON sentences.rowid=associations.sentence_id '
+                   'GROUP BY associations.sentence_id ORDER BY sum_weight DESC LIMIT 1', params)
+    return ctx.cursor.fetchone()
+
+@timed('db_lookup')
 def db_lookup(H):
     """Check if there are any matching words in the database.
     Returns None if there is no match else a tuple with 
     response text and confidence percent."""
-    words = get_words(H)
-    wordsfound = None
-    for word, n in words:
-        cursor.execute('SELECT word FROM words WHERE word=?', (word,))
-        row = cursor.fetchone()
-        if row:
-            wordsfound = True
-            break
-    if wordsfound is None:
+    words = analyze(H).words
+    if not words:
         return None
-    # retrieve the most likely answer from the database
-    cursor.execute('CREATE TEMPORARY TABLE results(sentence_id INT, sentence TEXT, weight REAL)')
     words_length = sum([n * len(word) for word, n in words])
-    for word, n in words:
-        weight = sqrt(n / float(words_length))
-        #cursor.execute('INSERT INTO results SELECT associations.sentence_id, sentences.sentence, ?*associations.weight/(4+sentences.used) FROM words INNER JOIN associations ON associations.word_id=words.rowid INNER JOIN sentences ON sentences.rowid=associations.sentence_id WHERE words.word=?', (weight, word,))
-        cursor.execute('INSERT INTO results SELECT associations.sentence_id, sentences.sentence, ?*associations.weight FROM words INNER JOIN associations ON associations.word_id=words.rowid INNER JOIN sentences ON sentences.rowid=associations.sentence_id WHERE words.word=?', (weight, word,))
+    query = [(word, sqrt(n / float(words_length))) for word, n in words]
+    # retrieve the most likely answer from the database using the brain engine set in config
+    if brain_engine == 'matrix':
+        row = get_brain_matrix().lookup(query)
+    else:
+        row = db_lookup_sql(query)
     # if matches were found, give the best one
-    cursor.execute('SELECT sentence_id, sentence, SUM(weight) AS sum_weight FROM results GROUP BY sentence_id ORDER BY sum_weight DESC LIMIT 1')
-    row = cursor.fetchone()
-    cursor.execute('DROP TABLE results')
     # otherwise, just randomly pick one of the least used sentences
     #if row is None:
     #    cursor.execute('SELECT rowid, sentence FROM sentences WHERE used = (SELECT MIN(used) FROM sentences) ORDER BY RANDOM() LIMIT 1')
@@ -513,6 +2017,74 @@ def db_lookup(H):
     # return bot's message
     return B, confidence
 
+def db_lookup_many(Hs):
+    """Check many questions against the database at once using the brain engine
+    set in config. Returns a list in the same order with None or a tuple with
+    response text and confidence percent for each question."""
+    queries = []
+    for H in Hs:
+        words = analyze(H).words
+        words_length = sum([n * len(word) for word, n in words])
+        queries.append([(word, sqrt(n / float(words_length))) for word, n in words])
+    if brain_engine == 'matrix':
+        rows = get_brain_matrix().lookup_many(queries)
+    else:
+        rows = db_lookup_sql_many(queries)
+    results = []
+    for row in rows:
+        if row is None:
+            results.append(None)
+        else:
+            results.append((row[1], row[2] * db_weight_mult))
+    return results
+
+def db_lookup_sql_many(queries):
+    """Score many query (word, weight) lists against the brain (db) with one sql query.
+    The query words are loaded into a temporary table with executemany.
+    Returns a list with None or a tuple with sentence rowid, sentence text and weight
+    for each query."""
+    in_transaction = ctx.connection.in_transaction
+    ctx.cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS query_words(qid INT, word TEXT, weight REAL)')
+    ctx.cursor.execute('DELETE FROM query_words')
+    ctx.cursor.executemany('INSERT INTO query_words VALUES (?, ?, ?)',
+                       [(qid, word, weight) for qid, query in enumerate(queries) for word, weight in query])
+    # sqlite returns the other columns from the row with the MAX() weight
+    ctx.cursor.execute('WITH scores AS (SELECT query_words.qid, associations.sentence_id, '
+                   'SUM(query_words.weight*associations.weight) AS sum_weight '
+                   'FROM query_words INNER JOIN words ON words.word=query_words.word '
+                   'INNER JOIN associations ON associations.word_id=words.rowid '
+                   'GROUP BY query_words.qid, associations.sentence_id) '
+                   'SELECT scores.qid, scores.sentence_id, sentences.sentence, MAX(scores.sum_weight) '
+                   'FROM scores INNER JOIN sentences ON sentences.rowid=scores.sentence_id '
+                   'GROUP BY scores.qid')
+    rows = [None] * len(queries)
+    for qid, sentence_id, sentence, weight in ctx.cursor.fetchall():
+        rows[qid] = (sentence_id, sentence, weight)
+    ctx.cursor.execute('DELETE FROM query_words')
+    if not in_transaction:
+        ctx.connection.commit()
+    return rows
+
+def read_questions(filename):
+    """Read questions from a jsonl file with question keys, a csv file
+    with a question header or a text file with one question per line.
+    Raises ValueError on a row without a text question."""
+    with open(filename, 'r', errors='ignore') as f:
+        if filename.endswith('.csv'):
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield text_field(row, 'question', filename, reader.line_num)
+        elif filename.endswith('.jsonl'):
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if line != '':
+                    yield text_field(json.loads(line), 'question', filename, n)
+        else:
+            for line in f:
+                line = line.strip()
+                if line != '':
+                    yield line
+
 # end database functions
 
 
@@ -527,12 +2099,147 @@ def format_response(response):
         response_formatted.append(line)
     return " ".join(response_formatted)
 
+class ResponseCache():
+    """Bounded LRU cache of response() results (or None) for questions, keyed on
+    the question's lemmas and words so the same question asked with different
+    punctuation or word order is a hit. Entries expire after ttl seconds (0 for
+    never) and the cache is emptied when Tobot learns something (the brain
+    generation changes) or the corpus file changes. If persist is True entries
+    are also stored in the database so they are kept across restarts."""
+    def __init__(self, connection, size=1000, ttl=86400, persist=False):
+        self.connection = connection
+        self.size = size
+        self.ttl = ttl or float('inf')
+        self.persist = persist
+        self.entries = OrderedDict()  # key -> (cached_at, response)
+        self.lock = threading.Lock()
+        self.generation = None
+        self.corpus_key = None
+
+    def check(self):
+        """Empty the cache if the brain or the corpus changed since it was filled."""
+        generation = get_brain_generation(self.connection)
+        corpus_key = ctx.corpus_key
+        with self.lock:
+            if generation == self.generation and corpus_key == self.corpus_key:
+                return
+            self.entries.clear()
+            self.generation = generation
+            self.corpus_key = corpus_key
+        if self.persist:
+            # don't commit part of an open ProcessedThreads transaction
+            in_transaction = self.connection.in_transaction
+            self.connection.execute('DELETE FROM response_cache WHERE generation != ? OR corpus_key != ?',
+                                    (generation, corpus_key))
+            if not in_transaction:
+                self.connection.commit()
+
+    def get(self, key):
+        """Return a tuple with True and the cached response for a cached question,
+        else (False, None)."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                metrics.inc('response_cache_hits')
+                return True, entry[1]
+        if self.persist:
+            row = self.connection.execute('SELECT response, confidence, source, cached_at FROM response_cache '
+                                          'WHERE key = ? AND generation = ? AND corpus_key = ?',
+                                          (key, self.generation, self.corpus_key)).fetchone()
+            if row is not None and now - row[3] < self.ttl:
+                res = None if row[0] is None else tuple(row[:3])
+                self.cache_put(key, res, row[3])
+                metrics.inc('response_cache_hits')
+                return True, res
+        metrics.inc('response_cache_misses')
+        return False, None
+
+    def put(self, key, res):
+        now = time.time()
+        self.cache_put(key, res, now)
+        if self.persist:
+            resp, confidence, source = res if res is not None else (None, None, None)
+            in_transaction = self.connection.in_transaction
+            self.connection.execute('INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (key, resp, confidence, source, self.generation, self.corpus_key, now))
+            if not in_transaction:
+                self.connection.commit()
+
+    def cache_put(self, key, res, cached_at):
+        with self.lock:
+            self.entries[key] = (cached_at, res)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def get_response_cache():
+    """Return the response cache set in config, None if it is turned off."""
+    if ctx.response_cache is None and response_cache_size > 0:
+        ctx.response_cache = ResponseCache(ctx.connection, response_cache_size, response_cache_ttl,
+                                           response_cache_persist)
+    return ctx.response_cache
+
+def response_cache_key(analysis):
+    """Cache key of a question, the lemmas used for the corpus file lookup
+    and the words used for the database lookup (both sorted)."""
+    return json.dumps([sorted(Counter(analysis.lemmas).items()), sorted(analysis.words)])
+
 def response(user_response):
     """Try to get best response to question using corpus file and database.
     Returns None if confidence is 0 else returns a tuple with 
-    response text, confidence percent and which source (file/db)."""
+    response text, confidence percent and which source (file/db).
+    user_response can be text or a MessageAnalysis."""
+    user_response = analyze(user_response)
+    cache = get_response_cache()
+    if cache is not None:
+        cache.check()
+        key = response_cache_key(user_response)
+        hit, res = cache.get(key)
+        if hit:
+            return res
     res_file = file_lookup(user_response)
     res_db = db_lookup(user_response)
+    res = pick_response(res_file, res_db)
+    if cache is not None:
+        cache.put(key, res)
+    return res
+
+def response_many(questions):
+    """Get the best responses to many questions at once, questions are scored
+    against the corpus file and database in batches instead of one at a time.
+    Returns a list in the same order as questions with None or a tuple with
+    response text, confidence percent and which source (file/db) for each question."""
+    analyses = [analyze(question) for question in questions]
+    results = [None] * len(analyses)
+    cache = get_response_cache()
+    if cache is not None:
+        cache.check()
+        keys = [response_cache_key(analysis) for analysis in analyses]
+        misses = []
+        for i, key in enumerate(keys):
+            hit, res = cache.get(key)
+            if hit:
+                results[i] = res
+            else:
+                misses.append(i)
+    else:
+        misses = list(range(len(analyses)))
+    res_files = file_lookup_many([analyses[i] for i in misses])
+    res_dbs = db_lookup_many([analyses[i] for i in misses])
+    for i, res_file, res_db in zip(misses, res_files, res_dbs):
+        results[i] = pick_response(res_file, res_db)
+        if cache is not None:
+            cache.put(keys[i], results[i])
+    return results
+
+def pick_response(res_file, res_db):
+    """Pick the best of the corpus file and database responses."""
     if res_file is not None and res_db is not None:
         resp_file, confidence_file = res_file
         resp_db, confidence_db = res_db
@@ -550,25 +2257,91 @@ def response(user_response):
     else:
         return None
 
+def build_corpus_index(sentences):
+    """Fit the tfidf vectorizer once over the corpus sentences.
+    Returns a tuple with the fitted vectorizer and the sparse
+    document-term matrix (rows are l2 normalized)."""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    TfidfVec = TfidfVectorizer(tokenizer=lem_normalize, stop_words='english', norm='l2')
+    tfidf = TfidfVec.fit_transform(sentences)
+    return TfidfVec, tfidf
+
+def get_corpus_index():
+    """Return the corpus tfidf index, loading it from the corpus cache
+    or fitting it (and saving to cache) on first use."""
+    if ctx.corpus_index is None:
+        corpus_key, sent_tokens, word_tokens = ctx.corpus
+        corpus_index = load_corpus_cache(corpus_key)
+        if corpus_index is None:
+            corpus_index = build_corpus_index(sent_tokens)
+            save_corpus_cache(corpus_key, sent_tokens, word_tokens, *corpus_index)
+        ctx.corpus_index = corpus_index
+    return ctx.corpus_index
+
+def query_vector(TfidfVec, lemmas):
+    """Build the l2 normalized tfidf vector of a message from its lemmas,
+    same as TfidfVec.transform without tokenizing the message again.
+    Stop words are never in the vocabulary so they don't need removing."""
+    return query_matrix(TfidfVec, [lemmas])
+
+def query_matrix(TfidfVec, lemmas_list):
+    """Build the tfidf matrix of many messages from their lemmas, one row per message."""
+    import numpy as np
+    from scipy.sparse import csr_matrix
+    vocabulary = TfidfVec.vocabulary_
+    rows = []
+    cols = []
+    vals = []
+    for row, lemmas in enumerate(lemmas_list):
+        counts = Counter(vocabulary[lemma] for lemma in lemmas if lemma in vocabulary)
+        if not counts:
+            continue
+        row_cols = list(counts.keys())
+        row_vals = np.array([counts[col] for col in row_cols], dtype=np.float64) * TfidfVec.idf_[row_cols]
+        row_vals /= np.sqrt(np.dot(row_vals, row_vals))
+        rows += [row] * len(row_cols)
+        cols += row_cols
+        vals.append(row_vals)
+    vals = np.concatenate(vals) if vals else np.zeros(0)
+    return csr_matrix((vals, (rows, cols)), shape=(len(lemmas_list), len(vocabulary)))
+
+def file_lookup_many(user_responses):
+    """Look up many questions in the corpus file with one sparse matrix product.
+    Returns a list in the same order with None or a tuple with response text
+    and confidence percent for each question."""
+    import numpy as np
+    TfidfVec, tfidf = get_corpus_index()
+    if tfidf.shape[0] == 0 or not user_responses:
+        return [None] * len(user_responses)
+    queries = query_matrix(TfidfVec, [analyze(user_response).lemmas for user_response in user_responses])
+    scores = (queries * tfidf.T).tocsr()
+    idxs = np.asarray(scores.argmax(axis=1)).flatten()
+    vals = np.asarray(scores.max(axis=1).todense()).flatten()
+    results = []
+    for idx, req_tfidf in zip(idxs, vals):
+        if req_tfidf <= 0:
+            results.append(None)
+        else:
+            results.append((ctx.sent_tokens[idx], req_tfidf))
+    return results
+
+@timed('file_lookup')
 def file_lookup(user_response):
     """Try to get response to question using nltk and sklearn from text in corpus file.
     Returns None if confidence is 0 else returns a tuple with 
     response text and confidence percent."""
-    tobo_response=''
-    sent_tokens.append(user_response)
-    TfidfVec = TfidfVectorizer(tokenizer=lem_normalize, stop_words='english')
-    tfidf = TfidfVec.fit_transform(sent_tokens)
-    vals = cosine_similarity(tfidf[-1], tfidf)
-    idx=vals.argsort()[0][-2]
-    flat = vals.flatten()
-    flat.sort()
-    req_tfidf = flat[-2]  # confidence percent
-    sent_tokens.remove(user_response)
+    TfidfVec, tfidf = get_corpus_index()
+    if tfidf.shape[0] == 0:
+        return None
+    # rows are l2 normalized so the dot product is the cosine similarity
+    query = query_vector(TfidfVec, analyze(user_response).lemmas)
+    vals = (tfidf * query.T).toarray().flatten()
+    idx = vals.argmax()
+    req_tfidf = vals[idx]  # confidence percent
     if req_tfidf == 0:
         return None
     else:
-        tobo_response = tobo_response+sent_tokens[idx]
-        return tobo_response, req_tfidf
+        return ctx.sent_tokens[idx], req_tfidf
 
 # standard greetings and responses
 GREETING_INPUTS = ("hello", "hi", "greetings", "sup", "what's up", "hey",)
@@ -618,7 +2391,18 @@ def teach_tobot_user_prompt(message, resp, host_reply):
             teach(message, resp)
 
 
-def process_message(msg, new_booking):
+def reply_key(msg):
+    """Idempotency key of a reply, one reply is sent for each newest post in a thread.
+    None if the post isn't known, the reply's text is used instead."""
+    if msg.get('post_id') is None:
+        return None
+    return '%s:%s' % (msg['thread_id'], msg['post_id'])
+
+
+@timed('process_message')
+def process_message(msg, new_booking, bot):
+    # the message is tokenized once and shared by the reply functions
+    analysis = MessageAnalysis(msg['message'])
     host_replied = False
     message_oneline = msg['message'].replace('\n', ' ')
     logger.info(color.BOLD + color.CYAN + msg['guest_name'] + " wrote " + message_oneline + color.END + color.END)
@@ -632,34 +2416,34 @@ def process_message(msg, new_booking):
         logger.info(color.BOLD + color.YELLOW + "New accepted booking, first message from guest." + color.END + color.END)
         reply = new_booking_reply % msg['guest_name']
         logger.info(color.BOLD + color.DARKCYAN + "Sending reply " + reply + color.END + color.END)
-        bot.send_reply(reply, msg['thread_id'])
+        bot.send_reply(msg['thread_id'], reply, reply_key(msg))
         bot.reply_count_response += 1
         return
     # send standard greeting reply and check if the guest
     # is sending a very short message like "hello"
-    elif greeting(msg['message']) is not None:
-        reply = greeting(msg['message']) % msg['guest_name']
+    elif greeting(analysis) is not None:
+        reply = greeting(analysis) % msg['guest_name']
         logger.info(color.BOLD + color.DARKCYAN + "Sending reply " + reply + color.END + color.END)
-        bot.send_reply(reply, msg['thread_id'])
+        bot.send_reply(msg['thread_id'], reply, reply_key(msg))
         bot.reply_count_response += 1
         return
     # send standard polite response message when the guest
     # is just sending a "thanks"
-    elif thanks(msg['message']) is not None and not is_question(msg['message']):
-        reply = thanks(msg['message']) % msg['guest_name']
+    elif thanks(analysis) is not None and not analysis.is_question:
+        reply = thanks(analysis) % msg['guest_name']
         logger.info(color.BOLD + color.DARKCYAN + "Sending reply " + reply + color.END + color.END)
-        bot.send_reply(reply, msg['thread_id'])
+        bot.send_reply(msg['thread_id'], reply, reply_key(msg))
         bot.reply_count_response += 1
         return
     # check if the message is not in a language we understand
     elif msg['translate']:
-        b = TextBlob(msg['message'])
-        lang = b.detect_language()
+        with timed('language_detection'):
+            lang = detect_language(msg['message'], msg['thread_id'])
         if lang not in allowed_languages:
             logger.info(color.BOLD + color.YELLOW + "Message needs translation but is in a language I don't understand (" + lang + ")." + color.END + color.END)
             reply = send_in_eng_msg % msg['guest_name']
             logger.info(color.BOLD + color.DARKCYAN + "Sending reply " + reply + color.END + color.END)
-            bot.send_reply(reply, msg['thread_id'])
+            bot.send_reply(msg['thread_id'], reply, reply_key(msg))
             bot.reply_count_response += 1
             return
         else:
@@ -668,17 +2452,17 @@ def process_message(msg, new_booking):
                 logger.info(color.BOLD + color.YELLOW + "Message not in English (en), skipping.." + color.END + color.END)
                 return
     # check if this is a question or statement
-    if not is_question(msg['message']):
+    if not analysis.is_question:
         logger.info(color.BOLD + color.YELLOW + "The message doesn't seem to be a question, skipping.." + color.END + color.END)
         return
     # try to send an appropriate reply to the guest
-    res = response(msg['message'])
+    res = response(analysis)
     if res is None:
         logger.info(color.BOLD + color.YELLOW + "Sorry I don't know how to answer, please train me more." + color.END + color.END)
         # TOBOT doesn't know how to answer, so send a generic message
         #reply = "Hello %s, I'll get back to you shortly." % msg['guest_name']
         #logger.info("Sending reply " + reply)
-        #bot.send_reply(reply, msg['thread_id'])
+        #bot.send_reply(msg['thread_id'], reply, reply_key(msg))
         bot.reply_count_noresponse += 1
         if training and host_replied:
             teach_tobot_user_prompt(msg['message'], None, msg['host_reply'])
@@ -701,14 +2485,336 @@ def process_message(msg, new_booking):
     # format reply and send
     reply = "Hello %s, %s" % (msg['guest_name'], resp)
     logger.info(color.BOLD + color.DARKCYAN + "Sending reply " + reply + color.END + color.END)
-    bot.send_reply(reply, msg['thread_id'])
+    bot.send_reply(msg['thread_id'], reply, reply_key(msg))
     bot.reply_count_response += 1
     # mark message as read
     if not testing and markread:
-        logger.info('Marking message %s as read' % message['id'])
-        res = bot.mark_message_read(message['id'])
-        logger.info(res)
-        bot.message_count_processed += 1
+        logger.info('Marking message %s as read' % msg['thread_id'])
+        bot.queue_mark_read(msg['thread_id'])
+
+
+def thread_version(message):
+    """Return the version of a message thread from the hosting inbox thread list,
+    the version changes when a post is added to the thread."""
+    for key in ('last_message_at', 'updated_at'):
+        if message.get(key):
+            return '%s:%s' % (message['posts_count'], message[key])
+    return str(message['posts_count'])
+
+
+def thread_confirmation_code(message):
+    """Return the confirmation code of the reservation of a message
+    thread from the hosting inbox thread list, None if it has none."""
+    code = message.get('reservation_confirmation_code')
+    if code is None and message.get('inquiry_reservation'):
+        code = message['inquiry_reservation'].get('confirmation_code')
+    return code
+
+
+def apply_reservation(msg):
+    """Use the booking status and check out date of the thread's reservation
+    (see prefetch_reservations), if it was found, instead of the thread's."""
+    reservation = msg.get('reservation')
+    if not reservation:
+        return
+    if reservation.get('status'):
+        msg['status'] = reservation['status']
+    if reservation.get('end_date'):
+        msg['checkout_date'] = reservation['end_date'][:10]
+
+
+def parse_message(message):
+    """Parse a message thread from the hosting inbox thread list into a msg dict."""
+    try:
+        msg = {
+            'thread_id': message['id'],
+            'checkin_date': message['inquiry_checkin_date'],
+            'checkout_date': message['inquiry_checkout_date'],
+            'listing_name': message['inquiry_listing']['name'],
+            'posts_count': message['posts_count'],
+            'requires_response': message['requires_response'],
+            'responded': message['responded'],
+            'status': message['status'],  # accepted, pending, cancelled
+            'guest_name': message['other_user']['first_name'],
+            'guest_id': message['other_user']['id'],
+            'translate': message['should_translate'],
+            'version': thread_version(message),
+            'confirmation_code': thread_confirmation_code(message)
+        }
+    except TypeError:
+        print(message)
+        raise
+    try:
+        msg['num_guests'] = message['inquiry_number_of_guests']
+    except KeyError:
+        msg['num_guests'] = message['inquiry_listing']['inquiry_number_of_guests']
+    return msg
+
+
+def process_thread(msg, mt, bot, last_post_id=None, host_replied=False):
+    """Build the conversations from the posts in message thread mt and
+    process the guest's messages. Posts are newest first, only the posts
+    newer than last_post_id (the thread's cursor) are processed.
+    host_replied is True if the host posted in the thread before the cursor.
+    Returns the thread's new cursor, a tuple with the newest post id and if
+    the host posted in the thread, or None if there are no new posts."""
+    # stop at the first post that was already processed
+    posts_count = 0
+    for post in mt['posts']:
+        if post['id'] == last_post_id:
+            break
+        posts_count += 1
+    if posts_count == 0:
+        return None
+    # the thread's cursor moves to the newest post once the posts are processed
+    host_posted = host_replied or any(post['user_id'] != msg['guest_id'] and post['message'] != ''
+                                      for post in mt['posts'][:posts_count])
+    cursor = (mt['posts'][0]['id'], host_posted)
+    # build a conversation list which cotains lists with any guest questions
+    # and corresponding host responses
+    new_booking = False
+    guest_post_count = 0
+    host_post_count = 0
+    conversations = []
+    pg = []
+    ph = []
+    n = posts_count - 1
+    with timed('conversation_build'):
+        while n >= 0:
+            last_post = mt['posts'][n]
+            if last_post['user_id'] == msg['guest_id'] and last_post['message'] != '':
+                pg.append(last_post['message'])
+                guest_post_count += 1
+            elif last_post['user_id'] != msg['guest_id'] and last_post['message'] != '':
+                ph.append(last_post['message'])
+                host_post_count += 1
+            if (len(pg) > 0 and len(ph) > 0) or n==0:
+                conversations.append([pg[:], ph[:]])
+                del pg[:]
+                del ph[:]
+            n -= 1
+    if guest_post_count == 0:
+        return cursor
+    if host_post_count == 0 and not host_replied:
+        new_booking = True
+    if not training:
+        #print(conversations)
+        msg['post_id'] = mt['posts'][0]['id']
+        guest_post = ' '.join(conversations[-1][0])
+        msg['message'] = guest_post.lower()
+        if len(conversations[-1][1]) > 0:
+            host_reply = ' '.join(conversations[-1][1])
+            msg['host_reply'] = host_reply.lower()
+        else:
+            msg['host_reply'] = None
+        if msg['message']:
+            process_message(msg, new_booking, bot)
+    else:
+        # remove beginning conversation with guest greeting and host check in instructions
+        if last_post_id is None:
+            conversations.pop(0)
+        if len(conversations) == 0:
+            return cursor
+        # remove ending conversation if checkout day has passed
+        checkout_date = msg['checkout_date'].split('-')
+        checkout_date = datetime(int(checkout_date[0]), int(checkout_date[1]), int(checkout_date[2]))
+        if datetime.now() >= checkout_date:
+            conversations.pop()
+        if len(conversations) == 0:
+            return cursor
+        #print(conversations)
+        # loop through all the conversations to train Tobot from past discussions
+        # with guest and host reply
+        for conv in conversations:
+            guest_post = ' '.join(conv[0])
+            msg['message'] = guest_post.lower()
+            host_reply = ' '.join(conv[1])
+            msg['host_reply'] = host_reply.lower()
+            if msg['message']:
+                process_message(msg, new_booking, bot)
+    return cursor
+
+
+class PollScheduler():
+    """Works out how long to wait between hosting inbox checks. The interval moves
+    between min_interval and max_interval with the recent unread message volume
+    (busy_unread or more unread messages is fully busy), the time the check took
+    is subtracted and random jitter (fraction) is added. After a reply is sent the
+    next check is after fast_lane seconds, since guests often reply quickly.
+    On errors or rate limiting the wait doubles up to backoff_max seconds."""
+    def __init__(self, min_interval=30, max_interval=300, busy_unread=5, jitter=0.1,
+                 fast_lane=20, backoff_max=900):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.busy_unread = busy_unread
+        self.jitter = jitter
+        self.fast_lane = fast_lane
+        self.backoff_max = backoff_max
+        self.volume = 0.0  # moving average of unread messages per check
+        self.errors = 0  # consecutive failed checks
+
+    def next_delay(self, cycle_seconds, unread=0, replied=False, error=False):
+        """Return the seconds to wait before the next inbox check."""
+        if error:
+            self.errors += 1
+            delay = min(self.backoff_max, self.min_interval * 2 ** self.errors)
+        else:
+            self.errors = 0
+            self.volume = 0.5 * self.volume + 0.5 * unread
+            busy = min(1.0, self.volume / float(self.busy_unread))
+            delay = self.max_interval - (self.max_interval - self.min_interval) * busy
+            if replied:
+                delay = min(delay, self.fast_lane)
+            delay -= cycle_seconds
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        if not error:
+            delay = min(delay, self.max_interval)
+        return max(0.0, delay)
+
+
+@timed('poll_cycle')
+def poll_inbox(bot):
+    """Check the hosting inbox once and process any new messages.
+    Returns the number of unread messages found or None if the
+    messages could not be read from the inbox."""
+    logger.info(color.BOLD + 'Checking for messages in hosting inbox..' + color.END)
+    bot.processed_threads.prune()
+    # get message threads in hosting inbox, page by page until the first thread
+    # that was already processed (all pages in training mode)
+    if training:
+        stop = None
+    else:
+        stop = lambda message: bot.processed_threads.seen(message['id'], thread_version(message))
+    messages = bot.iter_message_threads(stop=stop, max_pages=inbox_max_pages)
+    # check which message are unread and remove any support messages
+    messages_unread = []
+    messages_read = []
+    messages_support = []
+    for message in messages:
+        if message['unread'] == True and message['thread_sub_type'] != 'support_messaging_thread':
+            messages_unread.append(message)
+        elif message['unread'] == False:
+            messages_read.append(message)
+        else:
+            messages_support.append(message)
+    if bot.inbox_error and not messages_unread and not messages_read:
+        logger.info(color.BOLD + color.RED + 'Error getting messages' + color.END + color.END)
+        metrics.inc('inbox_errors')
+        return None
+    if training:
+        # combine all messages if in training mode
+        messages_unread += messages_read
+    else:
+        # remember the threads that aren't processed (read by the host or support threads)
+        # at their version too, so the next check stops paging at them
+        bot.processed_threads.add_many([(message['id'], thread_version(message))
+                                        for message in messages_read + messages_support])
+        # retry the threads that failed on an earlier check and weren't listed again
+        listed = set(message['id'] for message in messages)
+        retries = [message for message in bot.processed_threads.retries() if message['id'] not in listed]
+        if retries:
+            logger.info(color.BOLD + 'Retrying ' + str(len(retries)) + ' message threads' + color.END)
+            metrics.inc('thread_retries', len(retries))
+        messages_unread += retries
+    message_count = len(messages_unread)
+    logger.info(color.BOLD + 'I found ' + str(message_count) + ' unread messages' + color.END)
+    if message_count > 0:
+        logger.info(color.BOLD + 'I will process any new messages and try to send reply..' + color.END)
+    msgs = []
+    new_messages = []
+    for message in messages_unread:
+        #print(message)
+        msg = parse_message(message)
+        # check if message has already been processed
+        if bot.processed_threads.seen(msg['thread_id'], msg['version']):
+            continue
+        msgs.append(msg)
+        new_messages.append(message)
+    if not training:
+        # keep the new threads for a retry until they are recorded as processed
+        bot.processed_threads.retry(new_messages)
+    # look up the reservations of the new messages at once, only of the threads missing
+    # the booking status or check out date unless reservation_lookup is set
+    if reservation_lookup:
+        lookup_msgs = msgs
+    else:
+        lookup_msgs = [msg for msg in msgs if not msg['status'] or not msg['checkout_date']]
+    if lookup_msgs:
+        bot.prefetch_reservations(lookup_msgs, workers=fetch_workers)
+    threads = {}
+    for msg in msgs:
+        apply_reservation(msg)
+        logger.debug(msg)
+        # check if this is a new pending booking request or cancelled booking and 
+        # skip message since we want to review
+        if msg['status'] == 'pending' or msg['status'] == 'cancelled':
+            logger.info(color.BOLD + color.YELLOW + "This is a " + msg['status'] + " booking request, skipping.." + color.END + color.END)
+            bot.message_count += 1
+            bot.processed_threads.add(msg['thread_id'], msg['version'])
+            continue
+        # check if this is the guest's check out day and send check out message
+        date_today = datetime.strftime(datetime.now(), '%Y-%m-%d')
+        if not training and send_checkout_msg and msg['checkout_date'] == date_today and datetime.now().hour >= 11:
+            logger.info(color.BOLD + color.YELLOW + "Guest checks out today, sending checkout message" + color.END + color.END)
+            reply = checkout_message % msg['guest_name']
+            logger.info(color.BOLD + color.DARKCYAN + "Sending reply " + reply + color.END + color.END)
+            with bot.processed_threads.transaction():
+                bot.send_reply(msg['thread_id'], reply, '%s:checkout:%s' % (msg['thread_id'], date_today))
+                bot.processed_threads.add(msg['thread_id'], msg['version'])
+            bot.outbox.wakeup.set()
+            bot.message_count += 1
+            continue
+        bot.message_count += 1
+        threads[msg['thread_id']] = msg
+    # get message threads for guests concurrently, only the posts newer than
+    # the thread's cursor, and process them as they arrive. A thread is recorded
+    # as processed (and its cursor moved) in the same transaction as its replies,
+    # threads that fail to fetch or process stay in the retry set and are
+    # processed again on the next check
+    cursors = dict((thread_id, bot.processed_threads.get_cursor(thread_id)) for thread_id in threads)
+    last_post_ids = dict((thread_id, cursor[0]) for thread_id, cursor in cursors.items())
+    for thread_id, mt in bot.fetch_message_threads(list(threads), workers=fetch_workers,
+                                                   last_post_ids=last_post_ids, limit=thread_page_size):
+        if mt is None:
+            logger.info(color.BOLD + color.RED + 'Error getting message thread' + color.END + color.END)
+            metrics.inc('thread_fetch_errors')
+            continue
+        msg = threads[thread_id]
+        last_post_id, host_replied = cursors[thread_id]
+        try:
+            with bot.processed_threads.transaction():
+                cursor = process_thread(msg, mt, bot, last_post_id, host_replied)
+                if cursor is not None:
+                    bot.processed_threads.set_cursor(thread_id, cursor[0], cursor[1])
+                bot.processed_threads.add(thread_id, msg['version'])
+        except Exception as e:
+            logger.exception('Error processing message thread %s. %s' % (thread_id, e))
+            metrics.inc('thread_errors')
+            continue
+        # the sender may have looked before the replies were committed
+        bot.outbox.wakeup.set()
+    return message_count
+
+
+def poll_cycle(bot, scheduler):
+    """Check the hosting inbox once, catching any errors, and
+    return the seconds to wait before the next check."""
+    start_time = time.time()
+    reply_count = bot.reply_count_response
+    bot.rate_limited = False
+    try:
+        unread = poll_inbox(bot)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning('Error checking hosting inbox. %s' % e)
+        metrics.inc('inbox_errors')
+        unread = None
+    if stats_log:
+        logger.info('stats ' + json.dumps(metrics.snapshot(bot)))
+    error = unread is None or bot.rate_limited
+    if bot.rate_limited:
+        logger.info(color.BOLD + color.RED + 'Airbnb is rate limiting requests, backing off..' + color.END + color.END)
+    return scheduler.next_delay(time.time() - start_time, unread or 0,
+                                bot.reply_count_response > reply_count, error)
 
 
 def output_banner():
@@ -728,6 +2834,7 @@ def output_banner():
 
 
 if __name__ == '__main__':
+    setup_logging()
     output_banner()
 
     logger.info('Starting up.. (training: %s, testing: %s)' % (training, testing))
@@ -799,152 +2906,32 @@ if __name__ == '__main__':
         username=USERNAME,
         password=PASSWORD,
         apikey=APIKEY,
-        oauthtoken=OAUTHTOKEN
+        oauthtoken=OAUTHTOKEN,
+        pool_size=fetch_workers
         )
 
+    # fit corpus index now so the first reply doesn't pay for it
+    get_corpus_index()
+    if brain_engine == 'matrix':
+        get_brain_matrix()
+
     # output size of bot's brain
-    print(color.BOLD + color.PURPLE + 'TOBOT: BRAIN(file) (sentences: ' + str(len(sent_tokens)) + ', words: ' + str(len(word_tokens)) + ')' + color.END + color.END)
+    print(color.BOLD + color.PURPLE + 'TOBOT: BRAIN(file) (sentences: ' + str(len(ctx.sent_tokens)) + ', words: ' + str(len(ctx.word_tokens)) + ')' + color.END + color.END)
     print(color.BOLD + color.PURPLE + brain_dump(sizeonly=True) + color.END + color.END)
     
     print(color.BOLD + color.DARKCYAN + "TOBOT: My name is Tobot. I will answer your guest's questions and help send messages for you. If you want to exit press ctrl+c.." + color.END + color.END)
+    if not testing:
+        bot.start_sender()
+    if metrics_port:
+        start_metrics_server(metrics_port, bot)
+        logger.info('Serving metrics on http://127.0.0.1:%s/metrics' % metrics_port)
+    scheduler = PollScheduler(poll_interval_min, poll_interval_max, poll_busy_unread,
+                              poll_jitter, poll_fast_lane, poll_backoff_max)
     while True:
         try:
-            logger.info(color.BOLD + 'Checking for messages in hosting inbox..' + color.END)
-            # get message threads in hosting inbox
-            messages = bot.get_message_threads()
-            if messages is None:
-                logger.info(color.BOLD + color.RED + 'Error getting messages' + color.END + color.END)
-                break
-            # check which message are unread and remove any support messages
-            messages_unread = []
-            messages_read = []
-            for message in messages:
-                if message['unread'] == True and message['thread_sub_type'] != 'support_messaging_thread':
-                    messages_unread.append(message)
-                elif message['unread'] == False:
-                    messages_read.append(message)
-            if training:
-                # combine all messages if in training mode
-                messages_unread += messages_read
-            message_count = len(messages_unread)
-            logger.info(color.BOLD + 'I found ' + str(message_count) + ' unread messages' + color.END)
-            if message_count > 0:
-                logger.info(color.BOLD + 'I will process any new messages and try to send reply..' + color.END)
-            for message in messages_unread:
-                #print(message)
-                # parse message
-                try:
-                    msg = {
-                        'thread_id': message['id'],
-                        'checkin_date': message['inquiry_checkin_date'],
-                        'checkout_date': message['inquiry_checkout_date'],
-                        'listing_name': message['inquiry_listing']['name'],
-                        'posts_count': message['posts_count'],
-                        'requires_response': message['requires_response'],
-                        'responded': message['responded'],
-                        'status': message['status'],  # accepted, pending, cancelled
-                        'guest_name': message['other_user']['first_name'],
-                        'guest_id': message['other_user']['id'],
-                        'translate': message['should_translate']
-                    }
-                except TypeError:
-                    print(message)
-                    raise
-                try:
-                    msg['num_guests'] = message['inquiry_number_of_guests']
-                except KeyError:
-                    msg['num_guests'] = message['inquiry_listing']['inquiry_number_of_guests']
-                # end parse message
-                # check if message has already been processed
-                if msg['thread_id'] in bot.message_ids:
-                    continue
-                logger.debug(msg)
-                # check if this is a new pending booking request or cancelled booking and 
-                # skip message since we want to review
-                if msg['status'] == 'pending' or msg['status'] == 'cancelled':
-                    logger.info(color.BOLD + color.YELLOW + "This is a " + msg['status'] + " booking request, skipping.." + color.END + color.END)
-                    bot.message_count += 1
-                    bot.message_ids.append(msg['thread_id'])
-                    continue
-                # check if this is the guest's check out day and send check out message
-                date_today = datetime.strftime(datetime.now(), '%Y-%m-%d')
-                if not training and send_checkout_msg and msg['checkout_date'] == date_today and datetime.now().hour >= 11:
-                    logger.info(color.BOLD + color.YELLOW + "Guest checks out today, sending checkout message" + color.END + color.END)
-                    reply = checkout_message % msg['guest_name']
-                    logger.info(color.BOLD + color.DARKCYAN + "Sending reply " + reply + color.END + color.END)
-                    bot.send_reply(reply, msg['thread_id'])
-                    bot.message_count += 1
-                    bot.message_ids.append(message['id'])
-                    continue
-                bot.message_count += 1
-                bot.message_ids.append(msg['thread_id'])
-                # get message thread for guest
-                mt = bot.get_message_thread(msg['thread_id'])
-                if mt is None:
-                    logger.info(color.BOLD + color.RED + 'Error getting message thread' + color.END + color.END)
-                    continue
-                posts_count = len(mt['posts'])
-                # build a conversation list which cotains lists with any guest questions
-                # and corresponding host responses
-                new_booking = False
-                guest_post_count = 0
-                host_post_count = 0
-                conversations = []
-                pg = []
-                ph = []
-                n = posts_count - 1
-                while n >= 0:
-                    last_post = mt['posts'][n]
-                    if last_post['user_id'] == msg['guest_id'] and last_post['message'] != '':
-                        pg.append(last_post['message'])
-                        guest_post_count += 1
-                    elif last_post['user_id'] != msg['guest_id'] and last_post['message'] != '':
-                        ph.append(last_post['message'])
-                        host_post_count += 1
-                    if (len(pg) > 0 and len(ph) > 0) or n==0:
-                        conversations.append([pg[:], ph[:]])
-                        del pg[:]
-                        del ph[:]
-                    n -= 1
-                if guest_post_count == 0:
-                    continue
-                if host_post_count == 0:
-                    new_booking = True
-                if not training:
-                    #print(conversations)
-                    guest_post = ' '.join(conversations[-1][0])
-                    msg['message'] = guest_post.lower()
-                    if len(conversations[-1][1]) > 0:
-                        host_reply = ' '.join(conversations[-1][1])
-                        msg['host_reply'] = host_reply.lower()
-                    else:
-                        msg['host_reply'] = None
-                    if msg['message']:
-                        process_message(msg, new_booking)
-                else:
-                    # remove beginning conversation with guest greeting and host check in instructions
-                    conversations.pop(0)
-                    if len(conversations) == 0:
-                        continue
-                    # remove ending conversation if checkout day has passed
-                    checkout_date = msg['checkout_date'].split('-')
-                    checkout_date = datetime(int(checkout_date[0]), int(checkout_date[1]), int(checkout_date[2]))
-                    if datetime.now() >= checkout_date:
-                        conversations.pop()
-                    if len(conversations) == 0:
-                        continue
-                    #print(conversations)
-                    # loop through all the conversations to train Tobot from past discussions
-                    # with guest and host reply
-                    for conv in conversations:
-                        guest_post = ' '.join(conv[0])
-                        msg['message'] = guest_post.lower()
-                        host_reply = ' '.join(conv[1])
-                        msg['host_reply'] = host_reply.lower()
-                        if msg['message']:
-                            process_message(msg, new_booking)
-            logger.info(color.BOLD + 'Sleeping for 2 min..' + color.END)
-            time.sleep(120)
+            delay = poll_cycle(bot, scheduler)
+            logger.info(color.BOLD + 'Sleeping for %.0f sec..' % delay + color.END)
+            time.sleep(delay)
             continue
         except KeyboardInterrupt:
             break
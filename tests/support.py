@@ -0,0 +1,73 @@
+"""Helpers shared by the tests. airbnb_bot imports its settings from config.py,
+the tests use config.py.sample when there is no config.py so they run from a
+fresh clone, and each test gets its own brain (db) in a temporary directory."""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    with open(os.path.join(ROOT, 'config.py.sample'), 'r') as f:
+        exec(f.read(), config.__dict__)
+    sys.modules['config'] = config
+
+import airbnb_bot
+import tobot_replay
+
+
+class SequenceRandom():
+    """Stands in for the replay server's random numbers so injected errors happen
+    on chosen requests; values are used in turn, then 1.0 (no error)."""
+    def __init__(self, values):
+        self.values = list(values)
+        self.lock = threading.Lock()
+
+    def random(self):
+        with self.lock:
+            return self.values.pop(0) if self.values else 1.0
+
+    def uniform(self, a, b):
+        return a
+
+
+class ReplayTestCase():
+    """Mixin starting a ReplayServer with synthetic threads and giving each
+    test a fresh brain (db)."""
+    threads = 8
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='tobot_test_')
+        self.ctx = airbnb_bot.ctx
+        airbnb_bot.ctx = airbnb_bot.Context(os.path.join(self.tmpdir, 'tobot_db.sqlite'))
+        airbnb_bot.metrics.reset()
+        self.inbox = tobot_replay.ReplayInbox.synthetic(self.threads, random.Random(1))
+        self.server = None
+
+    def start_server(self, **kwargs):
+        """Start the replay server, kwargs are ReplayServer's latency and error options."""
+        self.server = tobot_replay.ReplayServer(self.inbox, **kwargs)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+    def make_bot(self, **kwargs):
+        return airbnb_bot.airbnbBot(apikey='test', oauthtoken='test', api_url=self.server.url, **kwargs)
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        airbnb_bot.ctx = self.ctx
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
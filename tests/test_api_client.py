@@ -0,0 +1,89 @@
+"""Timeouts and retries of the Airbnb api client against the replay server."""
+
+import time
+import unittest
+
+import requests
+
+from tests.support import airbnb_bot, ReplayTestCase, SequenceRandom
+
+
+class ApiClientTest(ReplayTestCase, unittest.TestCase):
+    threads = 3
+
+    def setUp(self):
+        ReplayTestCase.setUp(self)
+        # don't wait between retries
+        self.retry_backoff = airbnb_bot.api_retry_backoff
+        airbnb_bot.api_retry_backoff = 0
+
+    def tearDown(self):
+        airbnb_bot.api_retry_backoff = self.retry_backoff
+        ReplayTestCase.tearDown(self)
+
+    def test_read_timeout(self):
+        self.start_server(latency=2.0)
+        bot = self.make_bot(timeout=(1, 0.2), retries=0)
+        start = time.perf_counter()
+        with self.assertRaises(requests.exceptions.RequestException):
+            bot.get_message_threads()
+        self.assertLess(time.perf_counter() - start, 1.5)
+
+    def test_timeout_is_retried(self):
+        server = self.start_server(latency=0.5)
+        bot = self.make_bot(timeout=(1, 0.1), retries=2)
+        with self.assertRaises(requests.exceptions.RequestException):
+            bot.get_message_threads()
+        self.assertEqual(server.requests, 3)
+
+    def test_fetch_timeout_yields_none(self):
+        self.start_server(latency=2.0)
+        bot = self.make_bot(timeout=(1, 0.2), retries=0)
+        thread_ids = [thread['id'] for thread in self.inbox.threads]
+        start = time.perf_counter()
+        results = dict(bot.fetch_message_threads(thread_ids, workers=3))
+        self.assertEqual(results, dict((thread_id, None) for thread_id in thread_ids))
+        self.assertLess(time.perf_counter() - start, 1.5)
+
+    def test_retry_on_500(self):
+        server = self.start_server(error_rate=0.5)
+        # the first two requests get a 500
+        server.rng = SequenceRandom([0.0, 0.0])
+        bot = self.make_bot(retries=3)
+        threads = bot.get_message_threads()
+        self.assertEqual([thread['id'] for thread in threads], [thread['id'] for thread in self.inbox.threads])
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(airbnb_bot.metrics.counters['api_retries'], 2)
+        self.assertFalse(bot.rate_limited)
+
+    def test_retry_on_429(self):
+        server = self.start_server(error_rate=0.0, rate_limit_rate=0.5)
+        # the first request is rate limited
+        server.rng = SequenceRandom([0.0])
+        bot = self.make_bot(retries=3)
+        threads = bot.get_message_threads()
+        self.assertEqual(len(threads), len(self.inbox.threads))
+        self.assertEqual(server.requests, 2)
+        # polling backs off even though the retry succeeded
+        self.assertTrue(bot.rate_limited)
+
+    def test_retries_exhausted(self):
+        server = self.start_server(error_rate=1.0)
+        bot = self.make_bot(retries=2)
+        self.assertIsNone(bot.get_message_threads())
+        self.assertEqual(server.requests, 3)
+
+    def test_post_not_retried(self):
+        server = self.start_server(error_rate=0.5)
+        server.rng = SequenceRandom([0.0])
+        bot = self.make_bot(retries=3)
+        thread_id = self.inbox.threads[0]['id']
+        posts = len(self.inbox.thread_posts[thread_id]['posts'])
+        bot.send_message(thread_id, 'hello')
+        # a reply that may have been sent isn't sent again, the outbox checks it
+        self.assertEqual(server.requests, 1)
+        self.assertEqual(len(self.inbox.thread_posts[thread_id]['posts']), posts)
+
+
+if __name__ == '__main__':
+    unittest.main()
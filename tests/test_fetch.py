@@ -0,0 +1,115 @@
+"""Concurrent message thread fetches against the replay server."""
+
+import time
+import unittest
+
+from tests.support import airbnb_bot, ReplayTestCase
+
+
+class FetchMessageThreadsTest(ReplayTestCase, unittest.TestCase):
+    threads = 8
+
+    def test_fetches_every_thread_once(self):
+        self.start_server()
+        bot = self.make_bot(retries=0)
+        thread_ids = [thread['id'] for thread in self.inbox.threads]
+        results = list(bot.fetch_message_threads(thread_ids, workers=4))
+        self.assertEqual(sorted(thread_id for thread_id, mt in results), sorted(thread_ids))
+        for thread_id, mt in results:
+            self.assertEqual(mt['id'], thread_id)
+            self.assertEqual(mt['posts'], self.inbox.thread_posts[thread_id]['posts'])
+
+    def test_fetches_concurrently(self):
+        self.start_server(latency=0.2)
+        bot = self.make_bot(retries=0, pool_size=4)
+        thread_ids = [thread['id'] for thread in self.inbox.threads]
+        start = time.perf_counter()
+        results = list(bot.fetch_message_threads(thread_ids, workers=4))
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(results), len(thread_ids))
+        # 8 threads at 0.2s each take 1.6s one at a time, about 0.4s four at a time
+        self.assertLess(elapsed, 1.0)
+
+    def test_yields_threads_as_they_arrive(self):
+        self.start_server(latency=0.05, jitter=0.3, seed=3)
+        bot = self.make_bot(retries=0)
+        thread_ids = [thread['id'] for thread in self.inbox.threads]
+        arrived = []
+        for thread_id, mt in bot.fetch_message_threads(thread_ids, workers=len(thread_ids)):
+            arrived.append((time.perf_counter(), thread_id))
+        # with random latency the threads arrive out of request order,
+        # each yielded as soon as it is fetched
+        self.assertEqual(sorted(thread_id for t, thread_id in arrived), sorted(thread_ids))
+        self.assertNotEqual([thread_id for t, thread_id in arrived], thread_ids)
+
+    def test_only_posts_newer_than_cursor(self):
+        self.start_server()
+        bot = self.make_bot(retries=0)
+        thread_id = self.inbox.threads[0]['id']
+        posts = self.inbox.thread_posts[thread_id]['posts']
+        cursor = posts[-1]['id']
+        for i in range(12):
+            self.inbox.add_post(thread_id, self.inbox.threads[0]['other_user']['id'], 'post %s' % i)
+        (fetched_id, mt), = bot.fetch_message_threads([thread_id], last_post_ids={thread_id: cursor}, limit=5)
+        self.assertEqual(fetched_id, thread_id)
+        # newest first, ending with the cursor's post
+        self.assertEqual([post['id'] for post in mt['posts']],
+                         [post['id'] for post in self.inbox.thread_posts[thread_id]['posts']])
+        self.assertEqual(mt['posts'][-1]['id'], cursor)
+
+    def test_errors_yield_none(self):
+        self.start_server(error_rate=1.0)
+        bot = self.make_bot(retries=0)
+        thread_ids = [thread['id'] for thread in self.inbox.threads]
+        results = dict(bot.fetch_message_threads(thread_ids, workers=4))
+        self.assertEqual(set(results), set(thread_ids))
+        self.assertEqual(set(results.values()), {None})
+
+    def test_missing_thread_doesnt_stop_others(self):
+        self.start_server()
+        bot = self.make_bot(retries=0)
+        thread_ids = [thread['id'] for thread in self.inbox.threads] + [999]
+        results = dict(bot.fetch_message_threads(thread_ids, workers=4))
+        self.assertIsNone(results[999])
+        for thread_id in thread_ids[:-1]:
+            self.assertEqual(results[thread_id]['id'], thread_id)
+
+    def test_connection_error_yields_none(self):
+        self.start_server()
+        bot = self.make_bot(retries=0)
+        # nothing listens on the server's port once it is closed
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        results = dict(bot.fetch_message_threads([1, 2], workers=2))
+        self.assertEqual(results, {1: None, 2: None})
+
+
+class IterMessageThreadsTest(ReplayTestCase, unittest.TestCase):
+    threads = 120
+
+    def test_pages_in_order(self):
+        server = self.start_server()
+        bot = self.make_bot(retries=0)
+        threads = list(bot.iter_message_threads(limit=50))
+        self.assertEqual([thread['id'] for thread in threads], [thread['id'] for thread in self.inbox.threads])
+        self.assertFalse(bot.inbox_error)
+        self.assertEqual(server.requests, 3)
+
+    def test_stop_doesnt_prefetch(self):
+        server = self.start_server()
+        bot = self.make_bot(retries=0)
+        stop_id = self.inbox.threads[10]['id']
+        threads = list(bot.iter_message_threads(limit=50, stop=lambda thread: thread['id'] == stop_id))
+        self.assertEqual(len(threads), 10)
+        self.assertEqual(server.requests, 1)
+
+    def test_page_error(self):
+        self.start_server(error_rate=1.0)
+        bot = self.make_bot(retries=0)
+        self.assertEqual(list(bot.iter_message_threads(limit=50)), [])
+        self.assertTrue(bot.inbox_error)
+
+
+if __name__ == '__main__':
+    unittest.main()
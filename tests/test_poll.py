@@ -0,0 +1,83 @@
+"""Inbox checks (poll_inbox) against the replay server."""
+
+import unittest
+from unittest import mock
+
+from tests.support import airbnb_bot, ReplayTestCase
+
+
+class PollInboxTest(ReplayTestCase, unittest.TestCase):
+    threads = 3
+
+    def setUp(self):
+        super().setUp()
+        self.processed = []
+        patches = [
+            mock.patch.object(airbnb_bot, 'training', False),
+            mock.patch.object(airbnb_bot, 'reservation_lookup', False),
+            mock.patch.object(airbnb_bot, 'process_message',
+                              lambda msg, new_booking, bot: self.processed.append(msg['thread_id'])),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def fail_fetch_once(self, bot, thread_id):
+        """Make the first fetch of thread_id fail, as when the api request errors."""
+        fetch_message_threads = bot.fetch_message_threads
+        failed = []
+        def fetch(thread_ids, **kwargs):
+            for fetched_id, mt in fetch_message_threads(thread_ids, **kwargs):
+                if fetched_id == thread_id and not failed:
+                    failed.append(fetched_id)
+                    mt = None
+                yield fetched_id, mt
+        bot.fetch_message_threads = fetch
+
+    def test_processes_new_threads_once(self):
+        self.start_server()
+        bot = self.make_bot(retries=0)
+        airbnb_bot.poll_inbox(bot)
+        self.assertEqual(sorted(self.processed), sorted(thread['id'] for thread in self.inbox.threads))
+        del self.processed[:]
+        airbnb_bot.poll_inbox(bot)
+        self.assertEqual(self.processed, [])
+        self.assertEqual(bot.processed_threads.retries(), [])
+
+    def test_retries_failed_thread_behind_processed_thread(self):
+        self.start_server()
+        bot = self.make_bot(retries=0)
+        # the oldest thread fails, the newer threads are processed
+        failed_id = self.inbox.threads[-1]['id']
+        self.fail_fetch_once(bot, failed_id)
+        airbnb_bot.poll_inbox(bot)
+        self.assertNotIn(failed_id, self.processed)
+        self.assertEqual(len(self.processed), 2)
+        self.assertEqual(airbnb_bot.metrics.counters['thread_fetch_errors'], 1)
+        # the next check stops paging at the newest (processed) thread,
+        # the failed thread is processed from the retry set
+        del self.processed[:]
+        airbnb_bot.poll_inbox(bot)
+        self.assertEqual(self.processed, [failed_id])
+        self.assertEqual(bot.processed_threads.retries(), [])
+        del self.processed[:]
+        airbnb_bot.poll_inbox(bot)
+        self.assertEqual(self.processed, [])
+
+    def test_listed_thread_replaces_retry(self):
+        self.start_server()
+        bot = self.make_bot(retries=0)
+        failed_id = self.inbox.threads[-1]['id']
+        self.fail_fetch_once(bot, failed_id)
+        airbnb_bot.poll_inbox(bot)
+        # a new guest post moves the failed thread to the top of the inbox
+        thread = self.inbox.threads[-1]
+        self.inbox.add_post(failed_id, thread['other_user']['id'], 'is there parking?')
+        del self.processed[:]
+        airbnb_bot.poll_inbox(bot)
+        self.assertEqual(self.processed, [failed_id])
+        self.assertEqual(bot.processed_threads.retries(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
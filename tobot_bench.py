@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""tobot_bench.py - Airbnb Messaging Bot (TOBOT)
+See README.md or https://github.com/shirosaidev/airbnbbot
+for more information.
+
+Benchmarks TOBOT's reply pipeline against synthetic corpus files and
+brains (db) of different sizes and outputs the results as json.
+Each size runs in its own process in a temporary directory so peak
+memory (rss) is measured per size and your corpus and brain are not used.
+
+Copyright (C) Chris Park 2019
+airbnbbot is released under the Apache 2.0 license. See
+LICENSE for the full license text.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = [100, 1000, 10000, 100000]
+
+# messages in other languages for timing the language detector
+LANGUAGE_SAMPLES = [
+    "チェックインは何時からですか？",
+    "À quelle heure est l'arrivée et où est la clé ?",
+    "¿Dónde está la llave y a qué hora es la salida?",
+    "Wann ist der Check-in und wo finden wir den Schlüssel?",
+    "我们几点可以入住？",
+    "체크인은 몇 시부터인가요?",
+    "Во сколько заезд?",
+]
+
+
+def make_vocabulary(rng, size):
+    """Make a vocabulary of random pronounceable words."""
+    consonants = 'bcdfghjklmnprstvwz'
+    vowels = 'aeiou'
+    words = set()
+    while len(words) < size:
+        length = rng.randint(2, 4)
+        words.add(''.join(rng.choice(consonants) + rng.choice(vowels) for i in range(length)))
+    return sorted(words)
+
+
+def make_sentence(rng, vocabulary, min_words, max_words):
+    return ' '.join(rng.choice(vocabulary) for i in range(rng.randint(min_words, max_words)))
+
+
+def write_corpus(filename, sentences, rng, vocabulary):
+    """Write a corpus file like tobot_corpus.txt.sample, a title line
+    followed by a sentence, with size sentences."""
+    with open(filename, 'w') as f:
+        for i in range(sentences // 2):
+            f.write(make_sentence(rng, vocabulary, 2, 4).capitalize() + '\n')
+            f.write(make_sentence(rng, vocabulary, 8, 15).capitalize() + '.\n\n')
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def time_op(func, args):
+    """Call func once for each item in args and return latency stats in ms."""
+    latencies = []
+    start = time.perf_counter()
+    for arg in args:
+        t = time.perf_counter()
+        func(arg)
+        latencies.append((time.perf_counter() - t) * 1000)
+    total = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else None,
+        'throughput_per_sec': len(latencies) / total if total > 0 else None
+    }
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB on Linux
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+
+def baseline_preprocessing():
+    """Return get_words and lem_normalize as they were before the shared text
+    preprocessor (stop words list, lemmatizer and punctuation table built on
+    every call), to measure the preprocessing speedup against."""
+    import string
+    from collections import Counter
+    import nltk
+
+    def lem_tokens(tokens):
+        lemmer = nltk.stem.WordNetLemmatizer()
+        return [lemmer.lemmatize(token) for token in tokens]
+
+    def lem_normalize(text):
+        remove_punct_dict = dict((ord(punct), None) for punct in string.punctuation)
+        return lem_tokens(nltk.word_tokenize(text.lower().translate(remove_punct_dict)))
+
+    def get_words(text):
+        wordsList = nltk.word_tokenize(text)
+        fdist = nltk.probability.FreqDist(wordsList)
+        for word, count in fdist.most_common(2):
+            word = word.lower()
+            if word in wordsList:
+                wordsList.remove(word)
+        stop_words = nltk.corpus.stopwords.words("english")
+        wordsList = [word.lower() for word in wordsList if word.lower() not in stop_words]
+        return Counter(lem_normalize(" ".join(wordsList))).items()
+
+    return get_words, lem_normalize
+
+
+def speedup(baseline, timing):
+    """Ratio of baseline to new p50 latency."""
+    if not baseline['p50_ms'] or not timing['p50_ms']:
+        return None
+    return round(baseline['p50_ms'] / timing['p50_ms'], 1)
+
+
+class StubBot():
+    """Stands in for airbnbBot in process_message, nothing is sent."""
+    def __init__(self):
+        self.message_count = 0
+        self.message_count_processed = 0
+        self.reply_count_response = 0
+        self.reply_count_noresponse = 0
+
+    def send_reply(self, thread_id, message, key=None):
+        pass
+
+    def queue_mark_read(self, thread_id):
+        pass
+
+
+def run_size(size, iterations, engine, seed):
+    """Run the benchmarks for one corpus/brain size, in this process."""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng, max(200, min(20000, size // 2)))
+    scriptdir = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix='tobot_bench_')
+    result = {'size': size, 'engine': engine, 'iterations': iterations}
+    try:
+        os.chdir(workdir)
+        write_corpus('tobot_corpus.txt', size, rng, vocabulary)
+        # airbnb_bot reads the corpus and opens the brain in the working dir
+        sys.path.insert(0, scriptdir)
+        t = time.perf_counter()
+        import airbnb_bot
+        result['import_s'] = time.perf_counter() - t
+        # the associations per pair are about the question's word count (5)
+        pairs = [(make_sentence(rng, vocabulary, 5, 5) + '?', make_sentence(rng, vocabulary, 8, 15) + '.')
+                 for i in range(max(1, size // 5))]
+        t = time.perf_counter()
+        airbnb_bot.train_bot_many(pairs)
+        result['brain_build_s'] = time.perf_counter() - t
+        t = time.perf_counter()
+        airbnb_bot.get_corpus_index()
+        result['corpus_index_s'] = time.perf_counter() - t
+        airbnb_bot.brain_engine = engine
+        if engine == 'matrix':
+            t = time.perf_counter()
+            airbnb_bot.get_brain_matrix()
+            result['brain_matrix_load_s'] = time.perf_counter() - t
+        result['corpus_sentences'] = len(airbnb_bot.ctx.sent_tokens)
+        result['brain_associations'] = airbnb_bot.ctx.cursor.execute('SELECT COUNT(*) FROM associations').fetchone()[0]
+
+        bot = StubBot()
+        # time the whole pipeline, the response cache is timed separately below
+        airbnb_bot.response_cache_size = 0
+        airbnb_bot.training = False
+        airbnb_bot.testing = True
+        questions = ['what is ' + make_sentence(rng, vocabulary, 3, 8) + '?' for i in range(iterations)]
+        train_pairs = [('how ' + make_sentence(rng, vocabulary, 3, 8) + '?', 'bench ' + make_sentence(rng, vocabulary, 8, 12) + '.')
+                       for i in range(iterations)]
+        msgs = [{
+            'thread_id': i,
+            'guest_name': 'Guest',
+            'guest_id': 1,
+            'status': 'accepted',
+            'translate': False,
+            'message': question,
+            'host_reply': None
+        } for i, question in enumerate(questions)]
+
+        timings = {}
+        # per message preprocessing, old (baseline) vs shared text preprocessor
+        baseline_get_words, baseline_lem_normalize = baseline_preprocessing()
+        timings['get_words_baseline'] = time_op(baseline_get_words, questions)
+        timings['lem_normalize_baseline'] = time_op(baseline_lem_normalize, questions)
+        timings['lem_normalize'] = time_op(airbnb_bot.lem_normalize, questions)
+        timings['get_words'] = time_op(airbnb_bot.get_words, questions)
+        result['preprocessing_speedup'] = {
+            'get_words': speedup(timings['get_words_baseline'], timings['get_words']),
+            'lem_normalize': speedup(timings['lem_normalize_baseline'], timings['lem_normalize'])
+        }
+        timings['file_lookup'] = time_op(airbnb_bot.file_lookup, questions)
+        timings['db_lookup'] = time_op(airbnb_bot.db_lookup, questions)
+        timings['response'] = time_op(airbnb_bot.response, questions)
+        t = time.perf_counter()
+        airbnb_bot.response_many(questions)
+        timings['response_many'] = {'calls': 1, 'questions': len(questions), 'total_ms': (time.perf_counter() - t) * 1000}
+        airbnb_bot.response_cache_size = 1000
+        airbnb_bot.response_many(questions)
+        timings['response_cached'] = time_op(airbnb_bot.response, questions)
+        airbnb_bot.response_cache_size = 0
+        airbnb_bot.ctx.response_cache = None
+        # language detection of messages Airbnb flags for translation, half english
+        # half other languages, per message (uncached) and cached per thread
+        airbnb_bot.language_detector = 'local'
+        detector = airbnb_bot.LANGUAGE_DETECTORS['local']()
+        detector.detect('warm up')
+        lang_messages = [LANGUAGE_SAMPLES[i % len(LANGUAGE_SAMPLES)] if i % 2 else question
+                         for i, question in enumerate(questions)]
+        timings['detect_language'] = time_op(detector.detect, lang_messages)
+        for i, text in enumerate(lang_messages):
+            airbnb_bot.detect_language(text, i)
+        timings['detect_language_cached'] = time_op(lambda i: airbnb_bot.detect_language(lang_messages[i], i),
+                                                    range(len(lang_messages)))
+        timings['process_message'] = time_op(lambda msg: airbnb_bot.process_message(dict(msg), False, bot), msgs)
+        timings['train_bot'] = time_op(lambda pair: airbnb_bot.train_bot(*pair), train_pairs)
+        result['timings'] = timings
+        result['peak_rss_kb'] = peak_rss_kb()
+    finally:
+        os.chdir(scriptdir)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TOBOT reply pipeline with synthetic corpus and brain.')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                        help='comma separated corpus sentences/brain associations sizes (default %(default)s)')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='number of calls to time for each function (default %(default)s)')
+    parser.add_argument('--engine', default='sql', choices=['sql', 'matrix'],
+                        help='brain engine to use for db lookups (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default %(default)s)')
+    parser.add_argument('--output', help='write json results to this file instead of stdout')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        # quiet the bot's logging so it doesn't end up in the timings
+        import logging
+        logging.disable(logging.INFO)
+        print(json.dumps(run_size(args.worker, args.iterations, args.engine, args.seed)))
+        return
+
+    results = {
+        'python': sys.version.split()[0],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': []
+    }
+    for size in [int(size) for size in args.sizes.split(',')]:
+        print('benchmarking size %s..' % size, file=sys.stderr)
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                       '--worker', str(size), '--iterations', str(args.iterations),
+                                       '--engine', args.engine, '--seed', str(args.seed)])
+        results['results'].append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,10 +9,15 @@ airbnbbot is released under the Apache 2.0 license. See
 LICENSE for the full license text.
 """
 
+import argparse
+import shlex
 import sqlite3
-from airbnb_bot import read_corpus, db_connect, brain_dump, output_banner, train_bot, response, color
+import time
+from airbnb_bot import setup_logging, brain_dump, brain_rows, brain_stats, write_rows, BRAIN_TABLES, \
+    output_banner, train_bot, train_bot_many, read_training_pairs, read_questions, response, response_many, color
 from config import confidence_req
 
+setup_logging()
 output_banner()
 
 def output_commands():
@@ -20,16 +25,40 @@ def output_commands():
     help|?           prints help
     quit|bye|exit    exit program
     braindump        dumps database
+    braindump [sentences|words|associations] [-w WORD] [-s TEXT] [-n TOP] [-o FILE]
+                     dumps a table, only words or associations of word WORD,
+                     sentences or associations containing TEXT or the TOP most
+                     used sentences or associations with the highest weight,
+                     to a jsonl or csv file FILE
     brainsize        shows size of database
+    brainstats [-n TOP] shows statistics of database and the TOP words with
+                     the most associations
     trainbot         add new question and reply to database
+    trainbulk <file> add questions and replies from jsonl (question/response keys)
+                     or csv (question,response header) file to database
     testbot          looks up response in database to question
+    testfile <file>  looks up responses to questions in jsonl/csv (question key)
+                     or text file (one question per line)
     """)
 
-# simple cli for Tobot's brain
-print("Loading TOBOT's brain..")
-sent_tokens, word_tokens = read_corpus()
-connection, cursor = db_connect()
-print("Done.")
+def parse_args(parser, user_response):
+    """Parse command args, returns None if they are not valid."""
+    try:
+        return parser.parse_args(shlex.split(user_response)[1:])
+    except (SystemExit, ValueError):
+        return None
+
+dump_parser = argparse.ArgumentParser(prog='braindump', add_help=False)
+dump_parser.add_argument('table', nargs='?', choices=BRAIN_TABLES)
+dump_parser.add_argument('-w', '--word')
+dump_parser.add_argument('-s', '--sentence')
+dump_parser.add_argument('-n', '--top', type=int)
+dump_parser.add_argument('-o', '--output')
+
+stats_parser = argparse.ArgumentParser(prog='brainstats', add_help=False)
+stats_parser.add_argument('-n', '--top', type=int, default=10)
+
+# simple cli for Tobot's brain, the brain (db) and corpus are loaded when a command first needs them
 print("TOBOT CLI; type ? or help for commands, quit or bye to exit.")
 while True:
     try:
@@ -40,13 +69,55 @@ while True:
             output_commands()
         elif user_response == 'braindump':
             brain_dump()
+        elif user_response.split(' ')[0] == 'braindump':
+            args = parse_args(dump_parser, user_response)
+            if args is None:
+                continue
+            # filters without a table are for associations
+            table = args.table or 'associations'
+            try:
+                columns, rows = brain_rows(table, word=args.word, sentence=args.sentence, top=args.top)
+            except ValueError as e:
+                print("Error: %s" % e)
+                continue
+            start_time = time.time()
+            try:
+                count = write_rows(columns, rows, args.output)
+            except IOError as e:
+                print("Error writing dump file %s: %s" % (args.output, e))
+                continue
+            print("%s %s rows%s (%.2fs)" % (count, table, ' written to ' + args.output if args.output else '',
+                                            time.time() - start_time))
         elif user_response == 'brainsize':
             res = brain_dump(sizeonly=True)
             print(res)
+        elif user_response.split(' ')[0] == 'brainstats':
+            args = parse_args(stats_parser, user_response)
+            if args is None:
+                continue
+            stats = brain_stats(args.top)
+            for name in ('sentences', 'words', 'associations', 'associations_per_sentence',
+                         'associations_per_word', 'avg_weight', 'max_weight'):
+                print("%s: %s" % (name, stats[name]))
+            print("top words: " + ', '.join('%s (%s)' % (word, count) for word, count in stats['top_words']))
         elif user_response == 'trainbot':
             res = train_bot(None, None)
             if res is not None:
                 print(res)
+        elif user_response.split(' ')[0] == 'trainbulk':
+            filename = user_response[len('trainbulk'):].strip()
+            if filename == '':
+                print("Usage: trainbulk <file.jsonl|file.csv>")
+                continue
+            start_time = time.time()
+            try:
+                added, skipped = train_bot_many(read_training_pairs(filename))
+            except (IOError, ValueError, KeyError) as e:
+                print("Error reading training file %s: %s" % (filename, e))
+                continue
+            elapsed = time.time() - start_time
+            print("added %s pairs, %s already in db (%.2fs, %.1f pairs/sec)" %
+                  (added, skipped, elapsed, (added + skipped) / elapsed if elapsed > 0 else 0))
         elif user_response == 'testbot':
             h = input("Question: ")
             h = h.lower()
@@ -60,6 +131,32 @@ while True:
                     print("TOBOT: confidence too low to send reply, need more training")
             else:
                 print("TOBOT Reply: no response found, need more training")
+        elif user_response.split(' ')[0] == 'testfile':
+            filename = user_response[len('testfile'):].strip()
+            if filename == '':
+                print("Usage: testfile <file.jsonl|file.csv|file.txt>")
+                continue
+            try:
+                questions = [q.lower() for q in read_questions(filename)]
+            except (IOError, ValueError, KeyError) as e:
+                print("Error reading questions file %s: %s" % (filename, e))
+                continue
+            start_time = time.time()
+            results = response_many(questions)
+            elapsed = time.time() - start_time
+            found = 0
+            confident = 0
+            for h, res in zip(questions, results):
+                if res is not None:
+                    resp, confidence, source = res
+                    found += 1
+                    if confidence >= confidence_req:
+                        confident += 1
+                    print("Question: " + h + " TOBOT Reply: " + resp + " (confidence: %s (%s))" % (confidence, source))
+                else:
+                    print("Question: " + h + " TOBOT Reply: no response found")
+            print("%s questions, %s responses found, %s with confidence >= %s (%.2fs, %.1f questions/sec)" %
+                  (len(questions), found, confident, confidence_req, elapsed, len(questions) / elapsed if elapsed > 0 else 0))
         else:
             print("Sorry, I don't understand, type help or ? to see all commands")
     except KeyboardInterrupt:
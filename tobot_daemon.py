@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""tobot_daemon.py - Airbnb Messaging Bot (TOBOT)
+See README.md or https://github.com/shirosaidev/airbnbbot
+for more information.
+
+Runs TOBOT for several Airbnb host accounts in one process. Each account
+gets its own session, api key/oauth token and poll schedule, all accounts
+share the corpus index and the brain (db) and their inbox checks run on
+a pool of worker threads.
+
+Copyright (C) Chris Park 2019
+airbnbbot is released under the Apache 2.0 license. See
+LICENSE for the full license text.
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import airbnb_bot
+from airbnb_bot import logger, color
+
+
+class Account():
+    """A host account served by the daemon, its bot and poll schedule."""
+    def __init__(self, name, bot, scheduler):
+        self.name = name
+        self.bot = bot
+        self.scheduler = scheduler
+        self.next_poll = 0.0
+
+    def poll(self):
+        """Check the account's hosting inbox and schedule the next check."""
+        logger.info(color.BOLD + 'Checking account %s..' % self.name + color.END)
+        delay = airbnb_bot.poll_cycle(self.bot, self.scheduler)
+        logger.info(color.BOLD + 'Checking account %s again in %.0f sec..' % (self.name, delay) + color.END)
+        self.next_poll = time.time() + delay
+
+
+class AccountTotals():
+    """The bot counters summed over all accounts, for the metrics."""
+    def __init__(self, accounts):
+        self.accounts = accounts
+
+    def __getattr__(self, name):
+        return sum(getattr(account.bot, name) for account in self.accounts)
+
+
+def load_accounts(filename=None):
+    """Return the account settings (dicts with username, password, apikey and
+    oauthtoken) from a json file or airbnb_accounts in config."""
+    if filename is None:
+        return airbnb_bot.airbnb_accounts
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run TOBOT for several Airbnb host accounts.')
+    parser.add_argument('--accounts',
+                        help='json file with a list of accounts (username, password, apikey, oauthtoken), '
+                             'default is airbnb_accounts in config')
+    parser.add_argument('--workers', type=int, default=airbnb_bot.daemon_workers,
+                        help='accounts checked at the same time (default %(default)s)')
+    args = parser.parse_args()
+
+    airbnb_bot.setup_logging()
+    airbnb_bot.output_banner()
+    logger.info('Starting up.. (training: %s, testing: %s)' % (airbnb_bot.training, airbnb_bot.testing))
+
+    workers = args.workers
+    if airbnb_bot.training:
+        # training prompts on the console, so only one account at a time
+        logger.info('Training mode, checking one account at a time')
+        workers = 1
+
+    # all accounts share the brain (airbnb_bot.ctx), each worker thread gets its own connection
+    accounts = []
+    for settings in load_accounts(args.accounts):
+        name = settings.get('username') or 'account %s' % (len(accounts) + 1)
+        if not settings.get('apikey') or not settings.get('oauthtoken'):
+            logger.info('No apikey or oauthtoken for %s, skipping..' % name)
+            continue
+        bot = airbnb_bot.airbnbBot(
+            username=settings.get('username'),
+            password=settings.get('password'),
+            apikey=settings['apikey'],
+            oauthtoken=settings['oauthtoken'],
+            pool_size=airbnb_bot.fetch_workers
+            )
+        scheduler = airbnb_bot.PollScheduler(airbnb_bot.poll_interval_min, airbnb_bot.poll_interval_max,
+                                             airbnb_bot.poll_busy_unread, airbnb_bot.poll_jitter,
+                                             airbnb_bot.poll_fast_lane, airbnb_bot.poll_backoff_max)
+        if not airbnb_bot.testing:
+            bot.start_sender()
+        accounts.append(Account(name, bot, scheduler))
+    if not accounts:
+        logger.info('No accounts in airbnb_accounts in config or --accounts file, exiting..')
+        sys.exit(0)
+
+    # load the shared corpus index, nltk data and brain once before the workers start
+    airbnb_bot.get_corpus_index()
+    airbnb_bot.warm_up()
+    if airbnb_bot.brain_engine == 'matrix':
+        airbnb_bot.get_brain_matrix()
+
+    print(color.BOLD + color.PURPLE + 'TOBOT: BRAIN(file) (sentences: ' + str(len(airbnb_bot.ctx.sent_tokens)) + ', words: ' + str(len(airbnb_bot.ctx.word_tokens)) + ')' + color.END + color.END)
+    print(color.BOLD + color.PURPLE + airbnb_bot.brain_dump(sizeonly=True) + color.END + color.END)
+    print(color.BOLD + color.DARKCYAN + "TOBOT: I will answer guest's questions for %s accounts. If you want to exit press ctrl+c.." % len(accounts) + color.END + color.END)
+    if airbnb_bot.metrics_port:
+        airbnb_bot.start_metrics_server(airbnb_bot.metrics_port, AccountTotals(accounts))
+        logger.info('Serving metrics on http://127.0.0.1:%s/metrics' % airbnb_bot.metrics_port)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    running = {}
+    try:
+        while True:
+            now = time.time()
+            for account in accounts:
+                if account.next_poll <= now and account not in running.values():
+                    running[executor.submit(account.poll)] = account
+            # wait until a check finishes or the next account is due
+            waiting = [account.next_poll for account in accounts if account not in running.values()]
+            timeout = max(0.0, min(waiting) - time.time()) if waiting else None
+            if running:
+                done, not_done = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    account = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.exception('Error checking account %s. %s' % (account.name, e))
+                        account.next_poll = time.time() + airbnb_bot.poll_backoff_max
+            else:
+                time.sleep(timeout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""tobot_replay.py - Airbnb Messaging Bot (TOBOT)
+See README.md or https://github.com/shirosaidev/airbnbbot
+for more information.
+
+Replay (simulation) mode for TOBOT. Serves recorded (or synthetic) hosting
+inbox threads from a local stand-in for the Airbnb api, with optional
+latency and error injection, and runs TOBOT's inbox polling loop against
+it as fast as possible. Reports messages/sec and time spent per stage.
+
+Copyright (C) Chris Park 2019
+airbnbbot is released under the Apache 2.0 license. See
+LICENSE for the full license text.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import airbnb_bot
+
+HOST_ID = 1
+
+GUEST_MESSAGES = [
+    "hello",
+    "thanks!",
+    "what time is check in?",
+    "how do we get from kansai airport to the apartment?",
+    "where are the wifi instructions?",
+    "is there hot water for showers?",
+    "can we drop our bags off early?",
+    "which room is ours?",
+    "what is the address?",
+    "we will arrive late tonight, is that ok?",
+]
+
+
+class ReplayInbox():
+    """Hosting inbox served by the replay server, threads are kept newest first
+    as /v2/threads thread list items and /v2/threads/<id> threads (posts newest first),
+    reservations as /v2/reservations/<confirmation code> reservations."""
+    def __init__(self, threads=None, thread_posts=None, reservations=None):
+        self.threads = threads or []
+        self.thread_posts = thread_posts or {}
+        self.reservations = reservations or {}
+        self.lock = threading.Lock()
+        self.next_post_id = 1 + max([post['id'] for mt in self.thread_posts.values()
+                                     for post in mt['posts']] or [0])
+
+    @classmethod
+    def load(cls, path):
+        """Load recorded api responses from a directory, threads*.json files
+        with /v2/threads response bodies, thread_<id>.json files with
+        /v2/threads/<id> response bodies and reservation_<code>.json files
+        with /v2/reservations/<code> response bodies."""
+        threads = []
+        thread_posts = {}
+        reservations = {}
+        for filename in sorted(glob.glob(os.path.join(path, 'threads*.json'))):
+            with open(filename, 'r') as f:
+                threads += json.load(f)['threads']
+        for filename in glob.glob(os.path.join(path, 'thread_*.json')):
+            with open(filename, 'r') as f:
+                mt = json.load(f)['thread']
+            thread_posts[mt['id']] = mt
+        for filename in glob.glob(os.path.join(path, 'reservation_*.json')):
+            with open(filename, 'r') as f:
+                reservation = json.load(f)['reservation']
+            reservations[reservation['confirmation_code']] = reservation
+        return cls(threads, thread_posts, reservations)
+
+    @classmethod
+    def synthetic(cls, count, rng):
+        """Make an inbox with count unread threads from accepted guests."""
+        inbox = cls()
+        checkin = datetime.now() - timedelta(days=1)
+        checkout = datetime.now() + timedelta(days=3)
+        for i in range(count):
+            thread_id = 100000 + i
+            guest_id = 200000 + i
+            code = 'HM%08d' % i
+            inbox.threads.append({
+                'id': thread_id,
+                'unread': True,
+                'thread_sub_type': 'booking',
+                'inquiry_checkin_date': checkin.strftime('%Y-%m-%d'),
+                'inquiry_checkout_date': checkout.strftime('%Y-%m-%d'),
+                'inquiry_listing': {'name': 'Listing %s' % (i % 5)},
+                'inquiry_number_of_guests': rng.randint(1, 4),
+                'posts_count': 0,
+                'requires_response': True,
+                'responded': False,
+                'status': 'accepted',
+                'other_user': {'first_name': 'Guest%s' % i, 'id': guest_id},
+                'should_translate': False,
+                'updated_at': None,
+                'reservation_confirmation_code': code
+            })
+            inbox.reservations[code] = {
+                'confirmation_code': code,
+                'status': 'accepted',
+                'start_date': checkin.strftime('%Y-%m-%d'),
+                'end_date': checkout.strftime('%Y-%m-%d')
+            }
+            inbox.thread_posts[thread_id] = {'id': thread_id, 'posts': []}
+            inbox.add_post(thread_id, HOST_ID, 'Welcome! Check in instructions are in the welcome book.')
+            for j in range(rng.randint(1, 3)):
+                inbox.add_post(thread_id, guest_id, rng.choice(GUEST_MESSAGES))
+        return inbox
+
+    def add_post(self, thread_id, user_id, message):
+        """Add a new post to a thread and move the thread to the top of the inbox."""
+        with self.lock:
+            mt = self.thread_posts[thread_id]
+            mt['posts'].insert(0, {'id': self.next_post_id, 'user_id': user_id, 'message': message})
+            self.next_post_id += 1
+            for i, thread in enumerate(self.threads):
+                if thread['id'] == thread_id:
+                    thread['posts_count'] = len(mt['posts'])
+                    thread['updated_at'] = time.time()
+                    thread['unread'] = user_id != HOST_ID
+                    self.threads.insert(0, self.threads.pop(i))
+                    break
+
+    def add_guest_posts(self, rng):
+        """Add a new guest post to every thread (with posts from the guest)."""
+        for thread in list(self.threads):
+            self.add_post(thread['id'], thread['other_user']['id'], rng.choice(GUEST_MESSAGES))
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the Airbnb api serving a ReplayInbox."""
+    daemon_threads = True
+
+    def __init__(self, inbox, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ReplayRequestHandler)
+        self.inbox = inbox
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_port
+
+
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def inject(self):
+        """Sleep for the injected latency and return an injected error response or None."""
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            delay = server.latency + server.rng.uniform(0, server.jitter)
+            r = server.rng.random()
+        if delay > 0:
+            time.sleep(delay)
+        if r < server.error_rate:
+            status = 500
+        elif r < server.error_rate + server.rate_limit_rate:
+            status = 429
+        else:
+            return None
+        with server.lock:
+            server.errors += 1
+        return status, {'error_code': status, 'error_message': 'injected error'}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        qs = parse_qs(url.query)
+        limit = int(qs.get('_limit', ['50'])[0])
+        offset = int(qs.get('_offset', ['0'])[0])
+        error = self.inject()
+        if error is not None:
+            self.send_json(*error)
+            return
+        inbox = self.server.inbox
+        path = url.path.rstrip('/')
+        with inbox.lock:
+            if path == '/v2/threads':
+                self.send_json(200, {'threads': inbox.threads[offset:offset + limit]})
+                return
+            if path.startswith('/v2/threads/'):
+                try:
+                    mt = inbox.thread_posts[int(path.rsplit('/', 1)[1])]
+                except (KeyError, ValueError):
+                    self.send_json(404, {'error_code': 404, 'error_message': 'thread not found'})
+                    return
+                self.send_json(200, {'thread': dict(mt, posts=mt['posts'][offset:offset + limit])})
+                return
+            if path.startswith('/v2/reservations/'):
+                reservation = inbox.reservations.get(path.rsplit('/', 1)[1])
+                if reservation is None:
+                    self.send_json(404, {'error_code': 404, 'error_message': 'reservation not found'})
+                    return
+                self.send_json(200, {'reservation': reservation})
+                return
+        self.send_json(404, {'error_code': 404, 'error_message': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        error = self.inject()
+        if error is not None:
+            self.send_json(*error)
+            return
+        inbox = self.server.inbox
+        if urlparse(self.path).path.rstrip('/') == '/v2/messages':
+            # replies are added to the thread as host posts
+            try:
+                thread_id = int(form['thread_id'][0])
+                message = form['message'][0]
+            except (KeyError, ValueError):
+                self.send_json(400, {'error_code': 400, 'error_message': 'bad request'})
+                return
+            if thread_id not in inbox.thread_posts:
+                self.send_json(404, {'error_code': 404, 'error_message': 'thread not found'})
+                return
+            inbox.add_post(thread_id, HOST_ID, message)
+        self.send_json(200, {'message': {'id': 0}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded or synthetic inbox threads through TOBOT.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--recording', help='directory with recorded threads*.json and thread_<id>.json api responses')
+    source.add_argument('--synthetic', type=int, help='number of synthetic unread threads to make')
+    parser.add_argument('--cycles', type=int, default=1,
+                        help='number of inbox checks to run, a new guest post is added to every thread '
+                             'before each check after the first (default %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, help='injected api latency in ms (default %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra api latency up to ms (default %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of api requests answered with 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of api requests answered with 429')
+    parser.add_argument('--workers', type=int, default=airbnb_bot.fetch_workers,
+                        help='threads fetched at the same time (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default %(default)s)')
+    parser.add_argument('--verbose', action='store_true', help="show TOBOT's log output")
+    parser.add_argument('--output', help='write json results to this file instead of stdout')
+    args = parser.parse_args()
+
+    airbnb_bot.setup_logging()
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    rng = random.Random(args.seed)
+    if args.recording:
+        inbox = ReplayInbox.load(args.recording)
+    else:
+        inbox = ReplayInbox.synthetic(args.synthetic, rng)
+
+    # use a copy of the brain so replayed threads aren't stored as processed
+    tmpdir = tempfile.mkdtemp(prefix='tobot_replay_')
+    dbfile = os.path.join(tmpdir, 'tobot_db.sqlite')
+    if os.path.exists('tobot_db.sqlite'):
+        shutil.copy('tobot_db.sqlite', dbfile)
+    airbnb_bot.ctx = airbnb_bot.Context(dbfile)
+    airbnb_bot.ctx.cursor.execute('DELETE FROM processed_threads')
+    airbnb_bot.ctx.cursor.execute('DELETE FROM thread_cursors')
+    airbnb_bot.ctx.connection.commit()
+    # never prompt to teach or send real messages while replaying
+    airbnb_bot.training = False
+    airbnb_bot.testing = True
+    airbnb_bot.fetch_workers = args.workers
+
+    server = ReplayServer(inbox, args.latency / 1000.0, args.jitter / 1000.0,
+                          args.error_rate, args.rate_limit_rate, args.seed)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    bot = airbnb_bot.airbnbBot(apikey='replay', oauthtoken='replay',
+                               api_url=server.url, pool_size=args.workers)
+    airbnb_bot.get_corpus_index()
+    if airbnb_bot.brain_engine == 'matrix':
+        airbnb_bot.get_brain_matrix()
+    airbnb_bot.metrics.reset()
+
+    cycles = []
+    start = time.perf_counter()
+    try:
+        for cycle in range(args.cycles):
+            if cycle > 0:
+                inbox.add_guest_posts(rng)
+            t = time.perf_counter()
+            unread = airbnb_bot.poll_inbox(bot)
+            cycles.append({'seconds': time.perf_counter() - t, 'unread': unread, 'inbox_error': unread is None})
+    finally:
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+        airbnb_bot.ctx.connection.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    snapshot = airbnb_bot.metrics.snapshot(bot)
+    messages = snapshot['stages'].get('process_message', {'count': 0})['count']
+    results = {
+        'threads': len(inbox.threads),
+        'cycles': cycles,
+        'seconds': elapsed,
+        'threads_processed': bot.message_count,
+        'messages_processed': messages,
+        'messages_per_sec': messages / elapsed if elapsed > 0 else None,
+        'replies': bot.reply_count_response,
+        'no_replies': bot.reply_count_noresponse,
+        'api_requests': server.requests,
+        'api_errors_injected': server.errors,
+        'stages': snapshot['stages'],
+        'counters': snapshot['counters']
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()